@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for the EV3 / Scratch Link hot paths
+Run all: ./bench.py   Run some: ./bench.py templates
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import timeit
+import subprocess
+import tracemalloc
+
+from ev3protocol import EV3Protocol, EV3FrameReassembler, EV3Mailboxes
+from scratchlink import JSON_BACKEND, MethodTable, render_received_message, render_result
+
+
+def legacy_start_motor(ev3, motor_bits, speed):
+    """start_motor() as built before command templates"""
+    payload = (bytes([ev3.opOUTPUT_SPEED, 0x00]) +
+               ev3.encode_lc0(motor_bits) +
+               ev3.encode_lc1(speed))
+    payload += bytes([ev3.opOUTPUT_START, 0x00]) + ev3.encode_lc0(motor_bits)
+    return ev3.build_message(ev3.DIRECT_COMMAND_NO_REPLY, payload)
+
+
+def legacy_play_tone(ev3, volume, frequency, duration):
+    """play_tone() as built before command templates"""
+    payload = (bytes([ev3.opSOUND, ev3.TONE]) +
+               ev3.encode_lc1(volume) +
+               ev3.encode_lc2(frequency) +
+               ev3.encode_lc2(duration))
+    return ev3.build_message(ev3.DIRECT_COMMAND_NO_REPLY, payload)
+
+
+def legacy_receive(reassembler, chunk, send):
+    """on_bt_data_ready() as it was before the pre-rendered template"""
+    for frame in reassembler.feed(bytes(chunk)):
+        encoded = base64.b64encode(frame).decode()
+        response = {
+            'jsonrpc': '2.0',
+            'method': 'didReceiveMessage',
+            'params': {
+                'message': encoded,
+                'encoding': 'base64'
+            }
+        }
+        send(json.dumps(response))
+
+
+def legacy_dispatch(message, send, log):
+    """on_message_received() + handle_send() as they were before MethodTable"""
+    print(f"Received: {message}", file=log)
+    data = json.loads(message)
+    method = data.get('method')
+    if method == 'discover':
+        pass
+    elif method == 'connect':
+        pass
+    elif method == 'send':
+        payload = base64.b64decode(data['params']['message'])
+        print(f"Payload hex: {payload.hex()}", file=log)
+        response = {
+            'jsonrpc': '2.0',
+            'id': data.get('id'),
+            'result': len(payload)
+        }
+        send(json.dumps(response))
+
+
+def report(name, seconds, number):
+    """Print one benchmark result line"""
+    print(f"  {name:<28} {seconds / number * 1e6:8.3f} us/op")
+
+
+def peak_bytes(func, number=1000):
+    """Average peak of temporary memory traced during one call of func"""
+    func()  # Warm up caches so they are not counted
+    total = 0
+    tracemalloc.start()
+    for _ in range(number):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total / number
+
+
+def bench_templates(number=200000):
+    """Command templates against the concatenating builder"""
+    ev3 = EV3Protocol()
+    assert legacy_start_motor(EV3Protocol(), 2, 50) == EV3Protocol().start_motor(2, 50)
+    cases = [
+        ('start_motor (legacy)', lambda: legacy_start_motor(ev3, 2, 50)),
+        ('start_motor (template)', lambda: ev3.start_motor(2, 50)),
+        ('play_tone (legacy)', lambda: legacy_play_tone(ev3, 2, 1000, 1000)),
+        ('play_tone (template)', lambda: ev3.play_tone(2, 1000, 1000)),
+    ]
+    for name, func in cases:
+        report(name, timeit.timeit(func, number=number), number)
+
+
+def bench_receive(number=100000):
+    """EV3 reply to didReceiveMessage text, old path against template path"""
+    ev3 = EV3Protocol()
+    # A typical chunk: two complete sensor replies (counter, type, 4 byte float)
+    reply = bytes([0x07, 0x00, 0x01, 0x00, ev3.DIRECT_REPLY, 0x00, 0x00, 0x80, 0x3F])
+    chunk = reply * 2
+    legacy = EV3FrameReassembler()
+    fast = EV3FrameReassembler()
+    sent = []
+    legacy_receive(legacy, chunk, sent.append)
+    fast.feed_views(chunk, lambda frame: sent.append(render_received_message(frame)))
+    assert sent[:2] == sent[2:]
+
+    def send(text):
+        """Stand-in for sendTextMessage()"""
+
+    cases = [
+        ('receive (legacy)', lambda: legacy_receive(legacy, chunk, send)),
+        ('receive (template)',
+         lambda: fast.feed_views(chunk, lambda frame: send(render_received_message(frame)))),
+    ]
+    for name, func in cases:
+        report(name, timeit.timeit(func, number=number), number)
+        print(f"  {'':<28} {peak_bytes(func):8.0f} bytes peak temporary memory/op")
+
+
+def bench_dispatch(number=100000):
+    """Scratch 'send' flood through the JSON-RPC dispatcher"""
+    ev3 = EV3Protocol()
+    messages = [json.dumps({
+        'jsonrpc': '2.0',
+        'id': i,
+        'method': 'send',
+        'params': {
+            'message': base64.b64encode(ev3.start_motor(2, i % 100)).decode(),
+            'encoding': 'base64'
+        }
+    }) for i in range(1000)]
+
+    def send(text):
+        """Stand-in for sendTextMessage()"""
+
+    def handle_send(data):
+        payload = base64.b64decode(data['params']['message'])
+        send(render_result(data.get('id'), len(payload)))
+
+    table = MethodTable({'send': handle_send}, on_error=send)
+
+    with open(os.devnull, 'w') as log:
+        cases = [
+            ('dispatch (legacy)', lambda message: legacy_dispatch(message, send, log)),
+            (f'dispatch ({JSON_BACKEND})', table.dispatch),
+        ]
+        for name, func in cases:
+            seconds = timeit.timeit(lambda: [func(m) for m in messages], number=number // 1000)
+            report(name, seconds, number)
+            print(f"  {'':<28} {number / seconds:8.0f} messages/s")
+
+
+def bench_mailbox(number=100000):
+    """WRITEMAILBOX telemetry: encode, and decode from the read stream"""
+    ev3 = EV3Protocol()
+    stream = b''.join([ev3.write_mailbox('speed', 12.5), ev3.write_mailbox('state', 'running'),
+                       ev3.write_mailbox('done', False)])
+    reassembler = EV3FrameReassembler()
+    mailboxes = EV3Mailboxes()
+    received = []
+    mailboxes.subscribe('speed', lambda name, value: received.append(value), 'number')
+    mailboxes.subscribe('state', lambda name, value: received.append(value))
+    mailboxes.subscribe('done', lambda name, value: received.append(value), 'bool')
+    reassembler.feed_views(stream, mailboxes.feed)
+    assert received == [12.5, 'running', False]
+
+    def receive():
+        reassembler.feed_views(stream, mailboxes.feed)
+        received.clear()
+
+    cases = [
+        ('encode number', lambda: ev3.write_mailbox('speed', 12.5)),
+        ('encode text', lambda: ev3.write_mailbox('state', 'running')),
+        ('receive 3 messages', receive),
+    ]
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=number)
+        report(name, seconds, number)
+    print(f"  {'':<28} {3 * number / seconds:8.0f} messages/s received")
+
+
+def startup_run(script):
+    """Start a server script until it listens, return (seconds, peak RSS MB)"""
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, path, '--port', str(port), '--exit-after-start'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def bench_startup(runs=5):
+    """Server start-to-listen time and peak RSS (Qt against headless)"""
+    for script in ('slink.py', 'slink_headless.py'):
+        results = [startup_run(script) for _ in range(runs)]
+        if None in results:
+            print(f"  {script:<28} failed to start (missing dependencies?)")
+            continue
+        seconds = min(elapsed for elapsed, _ in results)
+        rss = max(rss for _, rss in results)
+        print(f"  {script:<28} {seconds * 1000:8.1f} ms {rss:8.1f} MB peak RSS")
+
+
+BENCHMARKS = {
+    'templates': bench_templates,
+    'receive': bench_receive,
+    'dispatch': bench_dispatch,
+    'mailbox': bench_mailbox,
+    'startup': bench_startup,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
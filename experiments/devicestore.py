@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+On-disk Bluetooth device state shared by the Scratch Link servers and GUIs
+Pure Python, no Qt imports
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock, a compaction may lose a concurrent append
+    fcntl = None
+
+log = logging.getLogger('slink.devicestore')
+
+
+def cache_dir():
+    """Per-user directory for slink state ($XDG_CACHE_HOME/slink)"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'slink')
+
+
+def default_registry_path():
+    """Where the device registry lives unless told otherwise"""
+    return os.path.join(cache_dir(), 'devices.jsonl')
+
+
+def class_of_device(device):
+    """Class of device of a QBluetoothDeviceInfo as the 24-bit integer"""
+    return (device.serviceClasses().value << 13 | device.majorDeviceClass().value << 8 |
+            device.minorDeviceClass() << 2)
+
+
+class DeviceRegistry:
+    """Known devices, kept in an append-only file for fast cold starts
+
+    Every line of the file is a JSON object with an address and the
+    fields that changed: name, device_class (class of device as an int),
+    channel (RFCOMM channel of the Serial Port Profile, null if unknown),
+    rssi and seen (Unix time). Loading replays the lines, later ones win,
+    so an update costs one short append; a file found mostly superseded
+    is compacted to one line per device. Sightings that only refresh rssi
+    and seen are written at most every SEEN_INTERVAL seconds per device,
+    flush() writes what is left. path None keeps the registry in memory.
+
+    Several processes share the file: appends hold a shared lock on
+    path.lock and compaction an exclusive one, re-reading the file under
+    it so lines other processes appended are kept.
+    """
+
+    FIELDS = ('name', 'device_class', 'channel', 'rssi', 'seen')
+    SEEN_ONLY = frozenset(('rssi', 'seen'))
+    SEEN_INTERVAL = 60.0
+
+    def __init__(self, path=None, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.devices = {}  # address -> {field: value}
+        self.dirty = {}  # address -> fields changed since the last append
+        self.written = {}  # address -> clock() of the last append
+        if path:
+            self.load()
+
+    def __contains__(self, address):
+        return address.upper() in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def read(self):
+        """Replay the file, return (devices, line count, torn at the end)
+
+        A torn or garbled line is skipped. Raises OSError.
+        """
+        devices = {}
+        lines = 0
+        line = b'\n'
+        with open(self.path, 'rb') as source:
+            for line in source:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    address = record.pop('address').upper()
+                except (ValueError, KeyError, AttributeError):
+                    continue
+                entry = devices.setdefault(address, {})
+                entry.update((field, record[field]) for field in self.FIELDS if field in record)
+        return devices, lines, not line.endswith(b'\n')
+
+    def load(self):
+        """Read the file, compacting it if needed"""
+        try:
+            self.devices, lines, torn = self.read()
+        except FileNotFoundError:
+            return
+        except OSError as error:
+            log.warning("Cannot read device registry %s: %s", self.path, error)
+            return
+        # Mostly superseded, or torn at the end (the next append would join that line)
+        if lines > 2 * len(self.devices) + 16 or torn:
+            self.compact()
+
+    @contextlib.contextmanager
+    def locked(self, exclusive):
+        """Hold the lock file, shared for appends, exclusive for compaction"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def compact(self):
+        """Rewrite the file with one line per device (temporary file, then rename)"""
+        if not self.path:
+            return
+        temporary = None
+        try:
+            with self.locked(exclusive=True):
+                devices, _, _ = self.read()  # With what others appended since load()
+                handle, temporary = tempfile.mkstemp(
+                    dir=os.path.dirname(self.path) or '.', suffix='.tmp',
+                    prefix=f".{os.path.basename(self.path)}.")
+                with os.fdopen(handle, 'w') as target:
+                    for address, entry in devices.items():
+                        target.write(json.dumps({'address': address, **entry}) + '\n')
+                os.replace(temporary, self.path)
+        except OSError as error:
+            log.warning("Cannot compact device registry %s: %s", self.path, error)
+            if temporary and os.path.exists(temporary):
+                os.unlink(temporary)
+
+    def append(self, address):
+        """Write the dirty fields of one device as a line"""
+        fields = self.dirty.pop(address, None)
+        if not fields or not self.path:
+            return
+        entry = self.devices[address]
+        self.written[address] = self.clock()
+        record = {'address': address}
+        record.update((field, entry.get(field)) for field in self.FIELDS if field in fields)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self.locked(exclusive=False), open(self.path, 'a') as target:
+                target.write(json.dumps(record) + '\n')
+        except OSError as error:
+            log.warning("Cannot write device registry %s: %s", self.path, error)
+
+    def update(self, address, **fields):
+        """Record what is known about a device, appending if anything changed"""
+        address = address.upper()
+        entry = self.devices.setdefault(address, {})
+        changed = {field for field, value in fields.items() if entry.get(field) != value}
+        if not changed:
+            return
+        entry.update((field, fields[field]) for field in changed)
+        dirty = self.dirty.setdefault(address, set())
+        dirty |= changed
+        if (dirty <= self.SEEN_ONLY and
+                self.clock() - self.written.get(address, 0) < self.SEEN_INTERVAL):
+            return
+        self.append(address)
+
+    def seen(self, address, name=None, device_class=None, rssi=None):
+        """Record a sighting from a discovery scan"""
+        fields = {'seen': round(self.clock())}
+        if name:
+            fields['name'] = name
+        if device_class is not None:
+            fields['device_class'] = device_class
+        if rssi is not None:
+            fields['rssi'] = rssi
+        self.update(address, **fields)
+
+    def flush(self):
+        """Write every change not on disk yet (e.g. at shutdown)"""
+        for address in list(self.dirty):
+            self.append(address)
+
+    def get(self, address):
+        """Fields known for address, or None"""
+        return self.devices.get(address.upper())
+
+    def known(self):
+        """(address, fields) of every device, most recently seen first"""
+        return sorted(self.devices.items(), key=lambda item: item[1].get('seen') or 0,
+                      reverse=True)
+
+    def channel(self, address):
+        """Last RFCOMM channel address answered on, or None"""
+        entry = self.devices.get(address.upper())
+        return entry.get('channel') if entry else None
+
+    def set_channel(self, address, channel):
+        """Remember the RFCOMM channel address answered on"""
+        self.update(address, channel=channel)
+
+    def forget_channel(self, address):
+        """Drop a channel that no longer works"""
+        if self.channel(address) is not None:
+            self.update(address, channel=None)
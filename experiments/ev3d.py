@@ -1,164 +1,242 @@
 #!/usr/bin/env python
 
 import sys
-import struct
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
-                             QHBoxLayout, QPushButton, QTextEdit, QLineEdit,
+                             QHBoxLayout, QPushButton, QLineEdit,
                              QLabel, QComboBox, QMessageBox)
-from PyQt6.QtCore import pyqtSignal
-from PyQt6.QtBluetooth import (QBluetoothDeviceDiscoveryAgent, QBluetoothSocket,
-                               QBluetoothAddress, QBluetoothUuid, QBluetoothServiceInfo)
-
-
-class EV3Protocol:
-    """EV3 Protocol message formatting"""
-
-    # Command types
-    DIRECT_COMMAND_REPLY = 0x00
-    DIRECT_COMMAND_NO_REPLY = 0x80
-    SYSTEM_COMMAND_REPLY = 0x01
-    SYSTEM_COMMAND_NO_REPLY = 0x81
-
-    # Reply types
-    DIRECT_REPLY = 0x02
-    SYSTEM_REPLY = 0x03
-    DIRECT_REPLY_ERROR = 0x04
-    SYSTEM_REPLY_ERROR = 0x05
-
-    # Opcodes for direct commands
-    opSOUND = 0x94
-    opUI_DRAW = 0x84
-    opOUTPUT_STEP_SPEED = 0xAE
-    opOUTPUT_SPEED = 0xA5
-    opOUTPUT_START = 0xA6
-    opOUTPUT_STOP = 0xA3
-    opINPUT_DEVICE = 0x99
-
-    # Sub-commands
-    TONE = 0x01
-    READY_SI = 0x1D
+from PyQt6.QtCore import pyqtSignal, pyqtSlot, QTimer
+from PyQt6.QtBluetooth import QBluetoothDeviceDiscoveryAgent
+
+from logview import LogView
+from sppworker import SPPWorker
+from devicestore import DeviceRegistry, class_of_device, default_registry_path
+from ev3protocol import (EV3Protocol, EV3FrameReassembler, EV3Mailboxes, EV3MotorScheduler,
+                         EV3RequestTracker)
+
+
+class EV3Worker(SPPWorker):
+    """SPP worker speaking the EV3 protocol: replies, sensors and motors"""
+
+    MOTOR_CONTROL_MS = 20  # Motor command flush interval (50 Hz)
 
     def __init__(self):
-        self.msg_counter = 0
-
-    @staticmethod
-    def encode_lc0(value):
-        """Encode short constant (single byte, +/- 31)"""
-        if -31 <= value <= 31:
-            return bytes([value & 0x3F])
-        raise ValueError("Value out of range for LC0")
-
-    @staticmethod
-    def encode_lc1(value):
-        """Encode long constant (one byte to follow, +/- 127)"""
-        return bytes([0x81, value & 0xFF])
-
-    @staticmethod
-    def encode_lc2(value):
-        """Encode long constant (two bytes to follow, +/- 32767)"""
-        return bytes([0x82]) + struct.pack('<h', value)
-
-    @staticmethod
-    def encode_lc4(value):
-        """Encode long constant (four bytes to follow)"""
-        return bytes([0x83]) + struct.pack('<i', value)
-
-    @staticmethod
-    def encode_lcs(string):
-        """Encode zero-terminated string"""
-        return bytes([0x84]) + string.encode('utf-8') + b'\x00'
-
-    @staticmethod
-    def encode_gv0(index):
-        """Encode global variable index (single byte)"""
-        return bytes([0x60 | (index & 0x1F)])
-
-    def build_message(self, cmd_type, payload, global_vars=0, local_vars=0):
-        """Build complete EV3 message with header"""
-        # Header: global and local variable allocation
-        header = struct.pack('<H', (local_vars << 10) | global_vars)
-
-        # Message body
-        body = bytes([cmd_type]) + header + payload
-
-        # Message counter (2 bytes, little endian)
-        counter = struct.pack('<H', self.msg_counter)
-        self.msg_counter = (self.msg_counter + 1) & 0xFFFF
-
-        # Complete message with length prefix
-        msg_length = len(body) + 2  # +2 for counter
-        length_prefix = struct.pack('<H', msg_length)
-
-        return length_prefix + counter + body
-
-    def play_tone(self, volume, frequency, duration, reply=False):
-        """Create a play tone direct command"""
-        cmd_type = self.DIRECT_COMMAND_REPLY if reply else self.DIRECT_COMMAND_NO_REPLY
-
-        payload = (bytes([self.opSOUND, self.TONE]) +
-                  self.encode_lc1(volume) +
-                  self.encode_lc2(frequency) +
-                  self.encode_lc2(duration))
-
-        return self.build_message(cmd_type, payload)
-
-    def read_sensor(self, port, mode=0):
-        """Create a read sensor direct command (returns 4 bytes float)"""
-        payload = (bytes([self.opINPUT_DEVICE, self.READY_SI]) +
-                  self.encode_lc0(0) +  # Layer 0
-                  self.encode_lc0(port) +  # Sensor port (0-3)
-                  self.encode_lc0(0) +  # Don't change type
-                  self.encode_lc0(mode) +  # Mode
-                  self.encode_lc0(1) +  # One dataset
-                  self.encode_gv0(0))  # Store in global var 0
-
-        return self.build_message(self.DIRECT_COMMAND_REPLY, payload, global_vars=4)
-
-    def stop_motor(self, motor_bits, brake=True):
-        """Stop motors (motor_bits: 1=A, 2=B, 4=C, 8=D)"""
-        payload = (bytes([self.opOUTPUT_STOP, 0x00]) +  # opOUTPUT_STOP, layer 0
-                  self.encode_lc0(motor_bits) +
-                  self.encode_lc0(1 if brake else 0))
-
-        return self.build_message(self.DIRECT_COMMAND_NO_REPLY, payload)
-
-    def start_motor(self, motor_bits, speed):
-        """Start motors at speed (motor_bits: 1=A, 2=B, 4=C, 8=D, speed: -100 to 100)"""
-        payload = (bytes([self.opOUTPUT_SPEED, 0x00]) +  # opOUTPUT_SPEED, layer 0
-                  self.encode_lc0(motor_bits) +
-                  self.encode_lc1(speed))
-
-        # Start the motor
-        payload += bytes([self.opOUTPUT_START, 0x00]) + self.encode_lc0(motor_bits)
-
-        return self.build_message(self.DIRECT_COMMAND_NO_REPLY, payload)
-
-    @staticmethod
-    def parse_reply(data):
-        """Parse EV3 reply message"""
-        if len(data) < 5:
-            return None
-
-        reply_size = struct.unpack('<H', data[0:2])[0]
-        msg_counter = struct.unpack('<H', data[2:4])[0]
-        reply_type = data[4]
-
-        result = {
-            'size': reply_size,
-            'counter': msg_counter,
-            'type': reply_type,
-            'payload': data[5:] if len(data) > 5 else b''
-        }
-
-        return result
+        super().__init__()
+        self.ev3 = EV3Protocol()  # Initialize EV3 protocol handler
+        self.reassembler = EV3FrameReassembler()  # Split stream into replies
+        self.requests = EV3RequestTracker()  # Replies matched by message counter
+        # Motor commands collapse to the newest state per port between ticks
+        self.motors = EV3MotorScheduler(self.ev3, self.write_motor_message)
+        # Messages brick programs send to the PC, shown whatever the mailbox
+        self.mailboxes = EV3Mailboxes()
+        self.mailboxes.subscribe(None, self.on_mailbox, 'auto')
+
+    @pyqtSlot()
+    def setup(self):
+        """Create the output, request and motor timers in the worker thread"""
+        super().setup()
+
+        # Fail requests whose reply never arrives
+        self.request_timer = QTimer(self)
+        self.request_timer.timeout.connect(self.requests.expire)
+        self.request_timer.start(250)
+
+        self.motor_timer = QTimer(self)
+        self.motor_timer.timeout.connect(self.flush_motors)
+        self.motor_timer.start(self.MOTOR_CONTROL_MS)
+
+    def reset(self):
+        """Drop partial frames, pending requests and motor state"""
+        self.reassembler.reset()
+        self.requests.cancel_all()
+        self.motors.reset()
+
+    def interrupt(self):
+        """Link dropped: fail requests in flight, resend the motor state once back
+
+        Mailbox subscriptions are local and stay as they are.
+        """
+        self.reassembler.reset()
+        self.requests.cancel_all("Connection lost")
+        self.motors.resend()
+
+    def handle_data(self, raw_bytes):
+        """Handle received data"""
+        self.log(f"Raw data received: {len(raw_bytes)} bytes", 'received')
+
+        # Replies can arrive split or merged, handle one complete frame at a time
+        for frame in self.reassembler.feed(raw_bytes):
+            if not self.mailboxes.feed(frame):
+                self.handle_reply(frame)
+
+    def on_mailbox(self, name, value):
+        """Show a message a brick program wrote to a mailbox"""
+        self.show(f"Mailbox {name}: {value}")
+        self.log(f"Mailbox {name}: {value!r}", 'received')
+
+    @pyqtSlot(str, str)
+    def send_mailbox(self, name, text):
+        """Write text to a brick mailbox as a number, logic or text message"""
+        if not self.is_connected():
+            return
+
+        # Numbers and true/false go out typed, anything else as text
+        lowered = text.strip().lower()
+        if lowered in ('true', 'false'):
+            value = lowered == 'true'
+        else:
+            try:
+                value = float(text)
+            except ValueError:
+                value = text
+        message = self.ev3.write_mailbox(name, value)
+        bytes_written = self.socket.write(message)
+
+        hex_msg = ' '.join(f'{b:02X}' for b in message)
+        self.log(f"Sent EV3 mailbox message ({bytes_written} bytes):", 'sent')
+        self.log(f"  Hex: {hex_msg}", 'sent')
+        self.log(f"  Command: Mailbox {name} = {value!r}", 'sent')
+
+    def handle_reply(self, frame):
+        """Handle one complete EV3 reply frame
+
+        Replies to tracked requests are decoded by their request's layout;
+        anything else is only shown, as hex.
+        """
+        reply = EV3Protocol.parse_reply(frame)
+        if reply is None:
+            hex_data = ' '.join(f'{b:02X}' for b in frame)
+            self.show(f"[Binary: {hex_data}]")
+            self.log(f"Short frame: {hex_data}", 'error')
+            return
+        if self.requests.resolve(reply):
+            return
+
+        reply_name = EV3Protocol.REPLY_NAMES.get(reply['type'], f"0x{reply['type']:02X}")
+        self.log(f"EV3 Reply - Type: {reply_name}, Counter: {reply['counter']} (unrequested)", 'received')
+        if reply['payload']:
+            hex_payload = ' '.join(f'{b:02X}' for b in reply['payload'])
+            self.log(f"Payload: {hex_payload}", 'received')
+            self.show(f"Hex: {hex_payload}")
+
+    @pyqtSlot()
+    def send_tone_command(self):
+        """Send EV3 play tone command"""
+        if not self.is_connected():
+            return
+
+        # Play 1kHz tone at volume 2 for 1 second
+        message = self.ev3.play_tone(volume=2, frequency=1000, duration=1000)
+        bytes_written = self.socket.write(message)
+
+        hex_msg = ' '.join(f'{b:02X}' for b in message)
+        self.log(f"Sent EV3 tone command ({bytes_written} bytes):", 'sent')
+        self.log(f"  Hex: {hex_msg}", 'sent')
+        self.log(f"  Command: Play 1kHz tone, volume 2, 1 second", 'sent')
+
+    @pyqtSlot()
+    def send_sensor_command(self):
+        """Send EV3 read sensor command"""
+        if not self.is_connected():
+            return
+
+        # Read sensor on port 1 (index 0), mode 0
+        message = self.ev3.read_sensor(port=0, mode=0)
+        self.requests.track(message, self.on_sensor_reply)
+        bytes_written = self.socket.write(message)
+
+        hex_msg = ' '.join(f'{b:02X}' for b in message)
+        self.log(f"Sent EV3 sensor read command ({bytes_written} bytes):", 'sent')
+        self.log(f"  Hex: {hex_msg}", 'sent')
+        self.log(f"  Command: Read sensor port 1, mode 0", 'sent')
+
+    def on_sensor_reply(self, reply, error):
+        """Handle the reply to a read sensor command"""
+        if error:
+            self.log(f"Sensor read failed: {error}", 'error')
+        else:
+            value, = reply['values']
+            self.show(f"Sensor value: {value:.2f}")
+            self.log(f"Sensor reply {reply['counter']}: {value:.2f}", 'received')
+
+    @pyqtSlot()
+    def send_sensors_command(self):
+        """Send one EV3 command reading all sensor ports and motor tachos"""
+        if not self.is_connected():
+            return
+
+        # Sensor ports 1-4 (0-3) and motors A-D (16-19), mode 0
+        reads = [(port, 0) for port in (0, 1, 2, 3, 16, 17, 18, 19)]
+        message = self.ev3.read_sensors(reads)
+        self.requests.track(message, lambda reply, error: self.on_sensors_reply(reads, reply, error))
+        bytes_written = self.socket.write(message)
+
+        hex_msg = ' '.join(f'{b:02X}' for b in message)
+        self.log(f"Sent EV3 batch sensor read command ({bytes_written} bytes):", 'sent')
+        self.log(f"  Hex: {hex_msg}", 'sent')
+        self.log(f"  Command: Read {len(reads)} ports, mode 0", 'sent')
+
+    def on_sensors_reply(self, reads, reply, error):
+        """Handle the reply to a batch sensor read command"""
+        if error:
+            self.log(f"Batch sensor read failed: {error}", 'error')
+        else:
+            text = ', '.join(f"{port}: {value:.2f}" for (port, _), value in zip(reads, reply['values']))
+            self.show(f"Sensor values: {text}")
+            self.log(f"Batch sensor reply {reply['counter']}: {text}", 'received')
+
+    @pyqtSlot(int, int)
+    def start_motor_command(self, motor_bits, speed):
+        """Queue an EV3 start motor command (also while reconnecting)"""
+        if not self.is_connected() and not self.reconnecting:
+            return
+
+        self.motors.set_speed(motor_bits=motor_bits, speed=speed)
+        self.log(f"  Command: Start motors 0x{motor_bits:X} at {speed}% speed", 'sent')
+
+    @pyqtSlot(int, bool)
+    def stop_motor_command(self, motor_bits, brake):
+        """Queue an EV3 stop motor command (also while reconnecting)"""
+        if not self.is_connected() and not self.reconnecting:
+            return
+
+        self.motors.stop(motor_bits=motor_bits, brake=brake)
+        self.log(f"  Command: Stop motors 0x{motor_bits:X}{' with brake' if brake else ''}", 'sent')
+
+    def flush_motors(self):
+        """Send the newest motor state once the previous write has drained"""
+        if not self.is_connected():
+            return
+        # While bytes still wait in the socket, newer states keep replacing pending ones
+        if self.socket.bytesToWrite() == 0:
+            self.motors.flush()
+
+    def write_motor_message(self, message):
+        """Write a motor command built by the scheduler"""
+        bytes_written = self.socket.write(message)
+
+        hex_msg = ' '.join(f'{b:02X}' for b in message)
+        self.log(f"Sent EV3 motor command ({bytes_written} bytes):", 'sent')
+        self.log(f"  Hex: {hex_msg}", 'sent')
 
 
 class SPPBluetoothApp(QMainWindow):
+    # Requests to the worker thread (queued connections)
+    connect_requested = pyqtSignal(str)
+    disconnect_requested = pyqtSignal()
+    send_requested = pyqtSignal(str)
+    tone_requested = pyqtSignal()
+    sensor_requested = pyqtSignal()
+    sensors_requested = pyqtSignal()
+    motor_start_requested = pyqtSignal(int, int)
+    motor_stop_requested = pyqtSignal(int, bool)
+    mailbox_requested = pyqtSignal(str, str)
+    stop_requested = pyqtSignal()
+
     def __init__(self):
         super().__init__()
-        self.socket = None
+        self.is_connected = False
         self.devices = {}
-        self.ev3 = EV3Protocol()  # Initialize EV3 protocol handler
+        self.registry = DeviceRegistry(default_registry_path())  # Devices seen before
 
         # Create discovery agent in main thread
         self.discovery_agent = QBluetoothDeviceDiscoveryAgent()
@@ -167,6 +245,27 @@ class SPPBluetoothApp(QMainWindow):
         self.discovery_agent.errorOccurred.connect(self.on_scan_error)
 
         self.init_ui()
+        self.add_known_devices()
+
+        # Socket I/O and EV3 parsing run in their own thread, so painting
+        # never delays reads and bursts of replies never freeze the window
+        self.worker = EV3Worker()
+        self.worker.connected.connect(self.on_connected)
+        self.worker.interrupted.connect(self.on_interrupted)
+        self.worker.disconnected.connect(self.on_disconnected)
+        self.worker.warning.connect(self.on_worker_warning)
+        self.worker.output.connect(self.on_worker_output)
+        self.connect_requested.connect(self.worker.connect_device)
+        self.disconnect_requested.connect(self.worker.disconnect_device)
+        self.send_requested.connect(self.worker.send_text)
+        self.tone_requested.connect(self.worker.send_tone_command)
+        self.sensor_requested.connect(self.worker.send_sensor_command)
+        self.sensors_requested.connect(self.worker.send_sensors_command)
+        self.motor_start_requested.connect(self.worker.start_motor_command)
+        self.motor_stop_requested.connect(self.worker.stop_motor_command)
+        self.mailbox_requested.connect(self.worker.send_mailbox)
+        self.stop_requested.connect(self.worker.stop)
+        self.worker_thread = self.worker.start()
 
     def init_ui(self):
         self.setWindowTitle("PyQt6 Bluetooth SPP with EV3 Protocol")
@@ -218,6 +317,11 @@ class SPPBluetoothApp(QMainWindow):
         self.sensor_btn.clicked.connect(self.send_sensor_command)
         self.sensor_btn.setEnabled(False)
         ev3_layout1.addWidget(self.sensor_btn)
+
+        self.sensors_btn = QPushButton("Read All Sensors")
+        self.sensors_btn.clicked.connect(self.send_sensors_command)
+        self.sensors_btn.setEnabled(False)
+        ev3_layout1.addWidget(self.sensors_btn)
         layout.addLayout(ev3_layout1)
 
         ev3_layout2 = QHBoxLayout()
@@ -232,10 +336,26 @@ class SPPBluetoothApp(QMainWindow):
         ev3_layout2.addWidget(self.motor_stop_btn)
         layout.addLayout(ev3_layout2)
 
+        # Mailbox messages to brick programs
+        mailbox_layout = QHBoxLayout()
+        self.mailbox_name = QLineEdit("abc")
+        self.mailbox_name.setMaximumWidth(120)
+        mailbox_layout.addWidget(QLabel("Mailbox:"))
+        mailbox_layout.addWidget(self.mailbox_name)
+        self.mailbox_value = QLineEdit()
+        self.mailbox_value.setPlaceholderText("Text, number or true/false...")
+        self.mailbox_value.returnPressed.connect(self.send_mailbox)
+        mailbox_layout.addWidget(self.mailbox_value)
+
+        self.mailbox_btn = QPushButton("Send Mailbox")
+        self.mailbox_btn.clicked.connect(self.send_mailbox)
+        self.mailbox_btn.setEnabled(False)
+        mailbox_layout.addWidget(self.mailbox_btn)
+        layout.addLayout(mailbox_layout)
+
         # Received data display
         layout.addWidget(QLabel("Received Data:"))
-        self.received_text = QTextEdit()
-        self.received_text.setReadOnly(True)
+        self.received_text = LogView(max_lines=1000, filters=False)
         self.received_text.setMaximumHeight(150)
         layout.addWidget(self.received_text)
 
@@ -255,8 +375,7 @@ class SPPBluetoothApp(QMainWindow):
 
         # Log display
         layout.addWidget(QLabel("Log:"))
-        self.log_text = QTextEdit()
-        self.log_text.setReadOnly(True)
+        self.log_text = LogView(max_lines=5000)
         layout.addWidget(self.log_text)
 
         # Clear button
@@ -264,15 +383,32 @@ class SPPBluetoothApp(QMainWindow):
         clear_btn.clicked.connect(self.clear_log)
         layout.addWidget(clear_btn)
 
-    def log(self, message):
-        """Add message to log"""
-        self.log_text.append(message)
+    def log(self, message, kind='info'):
+        """Add message to log (kind: info, sent, received or error)"""
+        self.log_text.append(message, kind)
+
+    def add_device(self, name, address):
+        """List a device once per address, True if it is new"""
+        if address in self.devices.values():
+            return False
+        display_text = f"{name} ({address})"
+        self.device_combo.addItem(display_text)
+        self.devices[display_text] = address
+        return True
+
+    def add_known_devices(self):
+        """List devices from the registry, most recently seen first"""
+        for address, fields in self.registry.known():
+            self.add_device(fields.get('name') or "Unknown Device", address)
+        if self.device_combo.count() > 0 and not self.is_connected:
+            self.connect_btn.setEnabled(True)
 
     def scan_devices(self):
         """Start scanning for Bluetooth devices"""
         self.log("Starting device scan...")
         self.device_combo.clear()
         self.devices.clear()
+        self.add_known_devices()
         self.scan_btn.setEnabled(False)
         self.discovery_agent.start()
 
@@ -280,10 +416,9 @@ class SPPBluetoothApp(QMainWindow):
         """Handle discovered device"""
         name = device.name() or "Unknown Device"
         address = device.address().toString()
-        display_text = f"{name} ({address})"
-        self.device_combo.addItem(display_text)
-        self.devices[display_text] = address
-        self.log(f"Found device: {display_text}")
+        self.registry.seen(address, device.name(), class_of_device(device), device.rssi())
+        if self.add_device(name, address):
+            self.log(f"Found device: {name} ({address})")
 
     def on_scan_finished(self):
         """Handle scan completion"""
@@ -294,7 +429,7 @@ class SPPBluetoothApp(QMainWindow):
 
     def on_scan_error(self, error):
         """Handle scan error"""
-        self.log(f"Scan error: {error}")
+        self.log(f"Scan error: {error}", 'error')
         self.scan_btn.setEnabled(True)
 
     def connect_device(self):
@@ -303,166 +438,96 @@ class SPPBluetoothApp(QMainWindow):
             return
 
         address = self.devices[self.device_combo.currentText()]
-        self.log(f"Connecting to {address}...")
-
-        self.socket = QBluetoothSocket(QBluetoothServiceInfo.Protocol.RfcommProtocol)
-        self.socket.connected.connect(self.on_connected)
-        self.socket.disconnected.connect(self.on_disconnected)
-        self.socket.readyRead.connect(self.on_data_received)
-        self.socket.errorOccurred.connect(self.on_socket_error)
-
-        spp_uuid = QBluetoothUuid(QBluetoothUuid.ServiceClassUuid.SerialPort)
-        self.socket.connectToService(QBluetoothAddress(address), spp_uuid)
+        self.connect_requested.emit(address)
 
         self.connect_btn.setEnabled(False)
         self.scan_btn.setEnabled(False)
 
     def on_connected(self):
         """Handle successful connection"""
-        self.log("Connected successfully!")
+        self.is_connected = True
         self.status_label.setText("Status: Connected")
         self.disconnect_btn.setEnabled(True)
         self.send_btn.setEnabled(True)
         self.tone_btn.setEnabled(True)
         self.sensor_btn.setEnabled(True)
+        self.sensors_btn.setEnabled(True)
         self.motor_start_btn.setEnabled(True)
         self.motor_stop_btn.setEnabled(True)
+        self.mailbox_btn.setEnabled(True)
+
+    def on_interrupted(self, reason):
+        """Link dropped, the worker is reconnecting (Disconnect cancels)"""
+        self.status_label.setText(f"Status: Reconnecting ({reason})...")
 
     def on_disconnected(self):
         """Handle disconnection"""
-        self.log("Disconnected")
+        self.is_connected = False
         self.status_label.setText("Status: Disconnected")
         self.disconnect_btn.setEnabled(False)
         self.send_btn.setEnabled(False)
         self.tone_btn.setEnabled(False)
         self.sensor_btn.setEnabled(False)
+        self.sensors_btn.setEnabled(False)
         self.motor_start_btn.setEnabled(False)
         self.motor_stop_btn.setEnabled(False)
+        self.mailbox_btn.setEnabled(False)
         self.connect_btn.setEnabled(True)
         self.scan_btn.setEnabled(True)
 
-    def on_socket_error(self, error):
-        """Handle socket errors"""
-        error_msg = self.socket.errorString()
-        self.log(f"Socket error: {error_msg}")
-        QMessageBox.warning(self, "Connection Error", error_msg)
-        self.on_disconnected()
+    def on_worker_warning(self, title, text):
+        """Show a warning reported by the worker"""
+        QMessageBox.warning(self, title, text)
+
+    def on_worker_output(self, lines):
+        """Append a batch of lines from the worker"""
+        for pane, line, kind in lines:
+            if pane == 'received':
+                self.received_text.append(line)
+            else:
+                self.log(line, kind)
 
     def disconnect_device(self):
         """Disconnect from device"""
-        if self.socket and self.socket.state() == QBluetoothSocket.SocketState.ConnectedState:
-            self.log("Disconnecting...")
-            self.socket.disconnectFromService()
-
-    def on_data_received(self):
-        """Handle received data"""
-        if self.socket:
-            data = self.socket.readAll()
-            raw_bytes = bytes(data)
-            self.log(f"Raw data received: {len(raw_bytes)} bytes")
-
-            # Try to parse as EV3 reply
-            reply = EV3Protocol.parse_reply(raw_bytes)
-            if reply:
-                self.log(f"EV3 Reply - Type: 0x{reply['type']:02X}, Counter: {reply['counter']}")
-
-                # Display payload
-                if reply['payload']:
-                    # Try to interpret as float if 4 bytes (sensor reading)
-                    if len(reply['payload']) == 4:
-                        try:
-                            value = struct.unpack('<f', reply['payload'])[0]
-                            self.received_text.append(f"Sensor value: {value:.2f}")
-                            self.log(f"Parsed sensor value: {value:.2f}")
-                        except:
-                            pass
-
-                    hex_payload = ' '.join(f'{b:02X}' for b in reply['payload'])
-                    self.log(f"Payload: {hex_payload}")
-                    self.received_text.append(f"Hex: {hex_payload}")
-            else:
-                # Also try UTF-8 decode
-                try:
-                    text = raw_bytes.decode('utf-8')
-                    self.received_text.append(f"Text: {text}")
-                    self.log(f"Received text: {text}")
-                except UnicodeDecodeError:
-                    hex_data = ' '.join(f'{b:02X}' for b in raw_bytes)
-                    self.received_text.append(f"[Binary: {hex_data}]")
-                    self.log(f"Binary data: {hex_data}")
+        self.disconnect_requested.emit()
 
     def send_data(self):
         """Send raw data to connected device"""
-        if not self.socket or self.socket.state() != QBluetoothSocket.SocketState.ConnectedState:
+        if not self.is_connected:
             QMessageBox.warning(self, "Not Connected", "Please connect to a device first")
             return
 
         text = self.send_input.text()
         if text:
-            data = text.encode('utf-8')
-            bytes_written = self.socket.write(data)
-            if bytes_written > 0:
-                self.log(f"Sent raw: {text} ({bytes_written} bytes)")
-                self.send_input.clear()
-            else:
-                self.log("Failed to send data")
-                QMessageBox.warning(self, "Send Error", "Failed to write data to socket")
+            self.send_requested.emit(text)
+            self.send_input.clear()
 
     def send_tone_command(self):
-        """Send EV3 play tone command"""
-        if not self.socket or self.socket.state() != QBluetoothSocket.SocketState.ConnectedState:
-            return
-
-        # Play 1kHz tone at volume 2 for 1 second
-        message = self.ev3.play_tone(volume=2, frequency=1000, duration=1000)
-        bytes_written = self.socket.write(message)
-
-        hex_msg = ' '.join(f'{b:02X}' for b in message)
-        self.log(f"Sent EV3 tone command ({bytes_written} bytes):")
-        self.log(f"  Hex: {hex_msg}")
-        self.log(f"  Command: Play 1kHz tone, volume 2, 1 second")
+        """Play 1kHz tone at volume 2 for 1 second"""
+        self.tone_requested.emit()
 
     def send_sensor_command(self):
-        """Send EV3 read sensor command"""
-        if not self.socket or self.socket.state() != QBluetoothSocket.SocketState.ConnectedState:
-            return
+        """Read sensor on port 1, mode 0"""
+        self.sensor_requested.emit()
 
-        # Read sensor on port 1 (index 0), mode 0
-        message = self.ev3.read_sensor(port=0, mode=0)
-        bytes_written = self.socket.write(message)
+    def send_sensors_command(self):
+        """Read all sensor ports and motor tachos"""
+        self.sensors_requested.emit()
 
-        hex_msg = ' '.join(f'{b:02X}' for b in message)
-        self.log(f"Sent EV3 sensor read command ({bytes_written} bytes):")
-        self.log(f"  Hex: {hex_msg}")
-        self.log(f"  Command: Read sensor port 1, mode 0")
+    def send_mailbox(self):
+        """Write the value to the named mailbox"""
+        name = self.mailbox_name.text()
+        if self.is_connected and name:
+            self.mailbox_requested.emit(name, self.mailbox_value.text())
+            self.mailbox_value.clear()
 
     def start_motor_command(self):
-        """Send EV3 start motor command"""
-        if not self.socket or self.socket.state() != QBluetoothSocket.SocketState.ConnectedState:
-            return
-
-        # Start motor B (bit 1 = 0x02) at 50% speed
-        message = self.ev3.start_motor(motor_bits=0x02, speed=50)
-        bytes_written = self.socket.write(message)
-
-        hex_msg = ' '.join(f'{b:02X}' for b in message)
-        self.log(f"Sent EV3 motor start command ({bytes_written} bytes):")
-        self.log(f"  Hex: {hex_msg}")
-        self.log(f"  Command: Start motor B at 50% speed")
+        """Start motor B (bit 1 = 0x02) at 50% speed"""
+        self.motor_start_requested.emit(0x02, 50)
 
     def stop_motor_command(self):
-        """Send EV3 stop motor command"""
-        if not self.socket or self.socket.state() != QBluetoothSocket.SocketState.ConnectedState:
-            return
-
-        # Stop motor B (bit 1 = 0x02) with brake
-        message = self.ev3.stop_motor(motor_bits=0x02, brake=True)
-        bytes_written = self.socket.write(message)
-
-        hex_msg = ' '.join(f'{b:02X}' for b in message)
-        self.log(f"Sent EV3 motor stop command ({bytes_written} bytes):")
-        self.log(f"  Hex: {hex_msg}")
-        self.log(f"  Command: Stop motor B with brake")
+        """Stop motor B (bit 1 = 0x02) with brake"""
+        self.motor_stop_requested.emit(0x02, True)
 
     def clear_log(self):
         """Clear log text"""
@@ -471,8 +536,9 @@ class SPPBluetoothApp(QMainWindow):
 
     def closeEvent(self, event):
         """Handle window close"""
-        if self.socket:
-            self.socket.disconnectFromService()
+        self.stop_requested.emit()
+        self.worker_thread.wait(2000)
+        self.registry.flush()
         event.accept()
 
 
@@ -0,0 +1,913 @@
+#!/usr/bin/env python
+"""
+EV3 protocol helpers shared by the Qt tools and the Scratch Link server
+Pure Python, no Qt imports
+"""
+
+import struct
+import time
+
+
+class EV3CommandTemplate:
+    """Pre-built EV3 message with parameter slots patched in place
+
+    parts is a sequence of constant bytes and struct.Struct parameter
+    slots. The message is laid out once; render() only writes the counter
+    and the parameter values into the existing buffer.
+    """
+
+    LENGTH = struct.Struct('<H')
+    COUNTER = struct.Struct('<H')
+
+    def __init__(self, cmd_type, parts, global_vars=0, local_vars=0):
+        body = bytearray([cmd_type])
+        body += struct.pack('<H', (local_vars << 10) | global_vars)
+        self.fields = []  # (offset in message, struct.Struct)
+        for part in parts:
+            if isinstance(part, struct.Struct):
+                self.fields.append((len(body) + 4, part))
+                body += bytes(part.size)
+            else:
+                body += part
+        self.buffer = bytearray(4) + body
+        self.LENGTH.pack_into(self.buffer, 0, len(body) + 2)
+
+    def render(self, counter, *values):
+        """Return the message for counter with the parameter values filled in"""
+        buffer = self.buffer
+        self.COUNTER.pack_into(buffer, 2, counter)
+        for (offset, field), value in zip(self.fields, values):
+            field.pack_into(buffer, offset, value)
+        return bytes(buffer)
+
+
+class EV3ReplyLayout:
+    """Global variable layout of a reply, decoded with one unpack_from()
+
+    fields are type names: 'float', 'int8', 'int16', 'int32' (and their
+    'uint' forms), or ('string', size) for a zero padded string of size
+    bytes. Layouts are immutable, get() shares one per field list.
+    """
+
+    CODES = {
+        'float': 'f',
+        'int8': 'b', 'uint8': 'B',
+        'int16': 'h', 'uint16': 'H',
+        'int32': 'i', 'uint32': 'I',
+    }
+
+    _layouts = {}  # fields -> EV3ReplyLayout
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        codes = []
+        self.strings = []  # Indices of string fields
+        for index, field in enumerate(self.fields):
+            if isinstance(field, tuple):
+                kind, size = field
+                if kind != 'string':
+                    raise ValueError(f"Unknown reply field: {field}")
+                codes.append(f'{size}s')
+                self.strings.append(index)
+            elif field in self.CODES:
+                codes.append(self.CODES[field])
+            else:
+                raise ValueError(f"Unknown reply field: {field}")
+        self.struct = struct.Struct('<' + ''.join(codes))
+        self.size = self.struct.size
+
+    @classmethod
+    def get(cls, fields):
+        """Shared layout for fields, compiled on first use"""
+        fields = tuple(fields)
+        layout = cls._layouts.get(fields)
+        if layout is None:
+            layout = cls._layouts[fields] = cls(fields)
+        return layout
+
+    @classmethod
+    def floats(cls, count):
+        """Layout of count consecutive floats (sensor readings)"""
+        return cls.get(('float',) * count)
+
+    def decode(self, payload, offset=0):
+        """Tuple of values at offset; ValueError if payload is too short"""
+        if len(payload) - offset < self.size:
+            raise ValueError(f"Reply holds {len(payload) - offset} bytes, "
+                             f"layout needs {self.size}")
+        values = self.struct.unpack_from(payload, offset)
+        if self.strings:
+            values = list(values)
+            for index in self.strings:
+                values[index] = values[index].split(b'\0', 1)[0].decode('utf-8', 'replace')
+            values = tuple(values)
+        return values
+
+
+class EV3Protocol:
+    """EV3 Protocol message formatting"""
+
+    # Command types
+    DIRECT_COMMAND_REPLY = 0x00
+    DIRECT_COMMAND_NO_REPLY = 0x80
+    SYSTEM_COMMAND_REPLY = 0x01
+    SYSTEM_COMMAND_NO_REPLY = 0x81
+
+    # Reply types
+    DIRECT_REPLY = 0x02
+    SYSTEM_REPLY = 0x03
+    DIRECT_REPLY_ERROR = 0x04
+    SYSTEM_REPLY_ERROR = 0x05
+
+    REPLY_NAMES = {
+        DIRECT_REPLY: 'DIRECT_REPLY',
+        SYSTEM_REPLY: 'SYSTEM_REPLY',
+        DIRECT_REPLY_ERROR: 'DIRECT_REPLY_ERROR',
+        SYSTEM_REPLY_ERROR: 'SYSTEM_REPLY_ERROR',
+    }
+
+    # System commands
+    BEGIN_DOWNLOAD = 0x92
+    CONTINUE_DOWNLOAD = 0x93
+    BEGIN_UPLOAD = 0x94
+    CONTINUE_UPLOAD = 0x95
+    CLOSE_FILEHANDLE = 0x98
+    LIST_FILES = 0x99
+    CONTINUE_LIST_FILES = 0x9A
+    CREATE_DIR = 0x9B
+    DELETE_FILE = 0x9C
+    WRITEMAILBOX = 0x9E
+
+    # System reply status (second payload byte)
+    SUCCESS = 0x00
+    END_OF_FILE = 0x08
+    SYSTEM_STATUS_NAMES = {
+        0x00: 'SUCCESS',
+        0x01: 'UNKNOWN_HANDLE',
+        0x02: 'HANDLE_NOT_READY',
+        0x03: 'CORRUPT_FILE',
+        0x04: 'NO_HANDLES_AVAILABLE',
+        0x05: 'NO_PERMISSION',
+        0x06: 'ILLEGAL_PATH',
+        0x07: 'FILE_EXITS',
+        0x08: 'END_OF_FILE',
+        0x09: 'SIZE_ERROR',
+        0x0A: 'UNKNOWN_ERROR',
+        0x0B: 'ILLEGAL_FILENAME',
+        0x0C: 'ILLEGAL_CONNECTION',
+    }
+
+    # The brick takes messages of up to 1024 bytes after the length prefix;
+    # CONTINUE_DOWNLOAD spends counter, type, command and handle on that
+    MAX_MESSAGE = 1024
+    MAX_DOWNLOAD_CHUNK = MAX_MESSAGE - 5
+
+    # Opcodes for direct commands
+    opNOP = 0x01
+    opSOUND = 0x94
+    opUI_DRAW = 0x84
+    opOUTPUT_STEP_SPEED = 0xAE
+    opOUTPUT_SPEED = 0xA5
+    opOUTPUT_START = 0xA6
+    opOUTPUT_STOP = 0xA3
+    opINPUT_DEVICE = 0x99
+
+    # Sub-commands
+    TONE = 0x01
+    READY_SI = 0x1D
+
+    # Bounded by the message size, not the 10-bit global variable space
+    # (1023 // 4 reads): a read costs at most 10 bytes, opINPUT_DEVICE and
+    # READY_SI, five LC0 arguments and a GV2 result offset, after the
+    # 7-byte direct command header
+    MAX_BATCH_READS = (MAX_MESSAGE - 7) // 10
+
+    # Parameter slots for command templates, message and reply headers
+    COUNTER = struct.Struct('<H')
+    _U8 = struct.Struct('<B')
+    _I16 = struct.Struct('<h')
+    _U16 = struct.Struct('<H')
+    _U32 = struct.Struct('<I')
+    _F32 = struct.Struct('<f')
+    _SYSTEM_HEADER = struct.Struct('<HHBB')  # Length, counter, type, command
+    _REPLY_HEADER = struct.Struct('<HHB')  # Length, counter, reply type
+
+    def __init__(self, first_counter=0, last_counter=0xFFFF):
+        # Counters run from first_counter to last_counter, so several users
+        # of one link (e.g. Scratch and the server's own polling) keep apart
+        self.first_counter = first_counter
+        self.last_counter = last_counter
+        self.msg_counter = first_counter
+
+        # Fixed-shape commands sent at high rate, compiled once per instance
+        tone = (bytes([self.opSOUND, self.TONE, 0x81]), self._U8,
+                b'\x82', self._I16, b'\x82', self._I16)
+        self.tone_templates = {
+            False: EV3CommandTemplate(self.DIRECT_COMMAND_NO_REPLY, tone),
+            True: EV3CommandTemplate(self.DIRECT_COMMAND_REPLY, tone),
+        }
+        self.stop_template = EV3CommandTemplate(
+            self.DIRECT_COMMAND_NO_REPLY,
+            (bytes([self.opOUTPUT_STOP, 0x00]), self._U8, self._U8))
+        self.start_template = EV3CommandTemplate(
+            self.DIRECT_COMMAND_NO_REPLY,
+            (bytes([self.opOUTPUT_SPEED, 0x00]), self._U8, b'\x81', self._U8,
+             bytes([self.opOUTPUT_START, 0x00]), self._U8))
+        self.mailbox_numbers = {}  # name -> message buffer with a float slot
+        self.mailbox_heads = {}  # name -> encoded name and terminator
+
+    def next_counter(self):
+        """Return the next message counter (16 bits, wraps)"""
+        counter = self.msg_counter
+        self.msg_counter = counter + 1 if counter < self.last_counter else self.first_counter
+        return counter
+
+    @staticmethod
+    def encode_lc0(value):
+        """Encode short constant (single byte, +/- 31)"""
+        if -31 <= value <= 31:
+            return bytes([value & 0x3F])
+        raise ValueError("Value out of range for LC0")
+
+    @staticmethod
+    def encode_lc1(value):
+        """Encode long constant (one byte to follow, +/- 127)"""
+        return bytes([0x81, value & 0xFF])
+
+    @staticmethod
+    def encode_lc2(value):
+        """Encode long constant (two bytes to follow, +/- 32767)"""
+        return bytes([0x82]) + struct.pack('<h', value)
+
+    @staticmethod
+    def encode_lc4(value):
+        """Encode long constant (four bytes to follow)"""
+        return bytes([0x83]) + struct.pack('<i', value)
+
+    @staticmethod
+    def encode_lcs(string):
+        """Encode zero-terminated string"""
+        return bytes([0x84]) + string.encode('utf-8') + b'\x00'
+
+    @staticmethod
+    def encode_gv0(index):
+        """Encode global variable index (single byte)"""
+        return bytes([0x60 | (index & 0x1F)])
+
+    @staticmethod
+    def encode_gv(index):
+        """Encode global variable index (GV0 up to 31, else GV1/GV2)"""
+        if 0 <= index <= 31:
+            return bytes([0x60 | index])
+        if index <= 0xFF:
+            return bytes([0xE1, index])
+        return bytes([0xE2]) + struct.pack('<H', index)
+
+    def build_message(self, cmd_type, payload, global_vars=0, local_vars=0):
+        """Build complete EV3 message with header"""
+        # Header: global and local variable allocation
+        header = struct.pack('<H', (local_vars << 10) | global_vars)
+
+        # Message body
+        body = bytes([cmd_type]) + header + payload
+
+        # Message counter (2 bytes, little endian)
+        counter = struct.pack('<H', self.next_counter())
+
+        # Complete message with length prefix
+        msg_length = len(body) + 2  # +2 for counter
+        length_prefix = struct.pack('<H', msg_length)
+
+        return length_prefix + counter + body
+
+    def nop(self, reply=True):
+        """Create a direct command doing nothing (keepalive, link check)"""
+        cmd_type = self.DIRECT_COMMAND_REPLY if reply else self.DIRECT_COMMAND_NO_REPLY
+        return self.build_message(cmd_type, bytes([self.opNOP]))
+
+    def play_tone(self, volume, frequency, duration, reply=False):
+        """Create a play tone direct command"""
+        # opSOUND TONE, LC1 volume, LC2 frequency, LC2 duration
+        return self.tone_templates[bool(reply)].render(
+            self.next_counter(), volume & 0xFF, frequency, duration)
+
+    def read_sensor(self, port, mode=0):
+        """Create a read sensor direct command (returns 4 bytes float)"""
+        payload = (bytes([self.opINPUT_DEVICE, self.READY_SI]) +
+                  self.encode_lc0(0) +  # Layer 0
+                  self.encode_lc0(port) +  # Sensor port (0-3)
+                  self.encode_lc0(0) +  # Don't change type
+                  self.encode_lc0(mode) +  # Mode
+                  self.encode_lc0(1) +  # One dataset
+                  self.encode_gv0(0))  # Store in global var 0
+
+        return self.build_message(self.DIRECT_COMMAND_REPLY, payload, global_vars=4)
+
+    def read_sensors(self, reads):
+        """Create one direct command reading several sensors
+
+        reads is a sequence of (port, mode) pairs; motor tachos are read
+        on ports 16-19. Each result is a 4 byte float stored at consecutive
+        global variable offsets, decode with parse_sensor_values().
+        """
+        if not 0 < len(reads) <= self.MAX_BATCH_READS:
+            raise ValueError(f"Batch must hold 1-{self.MAX_BATCH_READS} reads")
+        payload = bytearray()
+        for index, (port, mode) in enumerate(reads):
+            payload += bytes([self.opINPUT_DEVICE, self.READY_SI])
+            payload += self.encode_lc0(0)  # Layer 0
+            payload += self.encode_lc0(port)
+            payload += self.encode_lc0(0)  # Don't change type
+            payload += self.encode_lc0(mode)
+            payload += self.encode_lc0(1)  # One dataset
+            payload += self.encode_gv(index * 4)
+
+        message = self.build_message(self.DIRECT_COMMAND_REPLY, bytes(payload),
+                                     global_vars=len(reads) * 4)
+        if len(message) > self.MAX_MESSAGE:
+            raise ValueError(f"Batch command is {len(message)} bytes, "
+                             f"the brick takes {self.MAX_MESSAGE}")
+        return message
+
+    @staticmethod
+    def parse_sensor_values(payload, count):
+        """Decode a read_sensors() reply payload into a tuple of floats"""
+        return EV3ReplyLayout.floats(count).decode(payload)
+
+    def stop_motor(self, motor_bits, brake=True):
+        """Stop motors (motor_bits: 1=A, 2=B, 4=C, 8=D)"""
+        # opOUTPUT_STOP, layer 0, LC0 motors, LC0 brake
+        return self.stop_template.render(
+            self.next_counter(), self.encode_lc0(motor_bits)[0], 1 if brake else 0)
+
+    def start_motor(self, motor_bits, speed):
+        """Start motors at speed (motor_bits: 1=A, 2=B, 4=C, 8=D, speed: -100 to 100)"""
+        # opOUTPUT_SPEED, layer 0, LC0 motors, LC1 speed, then opOUTPUT_START
+        motors = self.encode_lc0(motor_bits)[0]
+        return self.start_template.render(
+            self.next_counter(), motors, speed & 0xFF, motors)
+
+    def build_system_message(self, command, params=b'', reply=True):
+        """Build complete EV3 system command message"""
+        cmd_type = self.SYSTEM_COMMAND_REPLY if reply else self.SYSTEM_COMMAND_NO_REPLY
+        return self._SYSTEM_HEADER.pack(len(params) + 4, self.next_counter(),
+                                        cmd_type, command) + params
+
+    @staticmethod
+    def encode_path(path):
+        """Zero-terminated file name for system commands"""
+        return path.encode('utf-8') + b'\x00'
+
+    def begin_download(self, size, path):
+        """Start writing a file of size bytes to path; reply holds the handle"""
+        return self.build_system_message(
+            self.BEGIN_DOWNLOAD, self._U32.pack(size) + self.encode_path(path))
+
+    def continue_download(self, handle, data):
+        """Next chunk (up to MAX_DOWNLOAD_CHUNK bytes) of a download"""
+        return self.build_system_message(self.CONTINUE_DOWNLOAD, bytes([handle]) + data)
+
+    def begin_upload(self, path, max_bytes):
+        """Start reading path; reply holds size, handle and the first bytes"""
+        return self.build_system_message(
+            self.BEGIN_UPLOAD, self._U16.pack(max_bytes) + self.encode_path(path))
+
+    def continue_upload(self, handle, max_bytes):
+        """Read the next bytes of an upload"""
+        return self.build_system_message(
+            self.CONTINUE_UPLOAD, bytes([handle]) + self._U16.pack(max_bytes))
+
+    def close_file_handle(self, handle):
+        """Release a file handle after an aborted transfer"""
+        # The handle is followed by a 32 byte hash the brick ignores
+        return self.build_system_message(self.CLOSE_FILEHANDLE, bytes([handle]) + bytes(32))
+
+    def list_files(self, path, max_bytes):
+        """List a directory; reply holds the listing size, handle and first bytes"""
+        return self.build_system_message(
+            self.LIST_FILES, self._U16.pack(max_bytes) + self.encode_path(path))
+
+    def continue_list_files(self, handle, max_bytes):
+        """Read the next bytes of a listing"""
+        return self.build_system_message(
+            self.CONTINUE_LIST_FILES, bytes([handle]) + self._U16.pack(max_bytes))
+
+    def create_dir(self, path):
+        """Create a directory"""
+        return self.build_system_message(self.CREATE_DIR, self.encode_path(path))
+
+    def delete_file(self, path):
+        """Delete a file or empty directory"""
+        return self.build_system_message(self.DELETE_FILE, self.encode_path(path))
+
+    def mailbox_head(self, name):
+        """Name size, name and terminator of a WRITEMAILBOX, cached per name"""
+        head = self.mailbox_heads.get(name)
+        if head is None:
+            encoded = self.encode_path(name)
+            head = self.mailbox_heads[name] = bytes([len(encoded)]) + encoded
+        return head
+
+    def write_mailbox(self, name, value):
+        """Create a WRITEMAILBOX system command for a brick program
+
+        str is sent as text (zero terminated), bool as logic (one byte),
+        int and float as a number (4 byte float), bytes as they are.
+        """
+        if isinstance(value, bool):
+            data = b'\x01' if value else b'\x00'
+        elif isinstance(value, (int, float)):
+            # Numbers stream at high rate: patch counter and value in place
+            buffer = self.mailbox_numbers.get(name)
+            if buffer is None:
+                head = self.mailbox_head(name)
+                buffer = self.mailbox_numbers[name] = bytearray(self._SYSTEM_HEADER.pack(
+                    len(head) + 10, 0, self.SYSTEM_COMMAND_NO_REPLY, self.WRITEMAILBOX)
+                    + head + self._U16.pack(4) + bytes(4))
+            self.COUNTER.pack_into(buffer, 2, self.next_counter())
+            self._F32.pack_into(buffer, len(buffer) - 4, value)
+            return bytes(buffer)
+        elif isinstance(value, str):
+            data = value.encode('utf-8') + b'\x00'
+        else:
+            data = bytes(value)
+        return self.build_system_message(
+            self.WRITEMAILBOX, self.mailbox_head(name) + self._U16.pack(len(data)) + data,
+            reply=False)
+
+    @classmethod
+    def motor_speed_key(cls, message):
+        """Return (layer, motor_bits, starts) if message only sets motor speed, else None
+
+        Matches a no-reply opOUTPUT_SPEED, optionally followed by
+        opOUTPUT_START for the same motors (the start_motor() shape), with
+        the speed as LC0 or LC1. A newer message of the same shape for the
+        same motors fully supersedes an older one; starts is part of the
+        key so a speed-only message never replaces one that starts them.
+        """
+        if len(message) < 11 or message[4] != cls.DIRECT_COMMAND_NO_REPLY:
+            return None
+        body = message[7:]
+        if body[0] != cls.opOUTPUT_SPEED:
+            return None
+        layer, motors = body[1], body[2]
+        if layer & 0xC0 or motors & 0xC0:
+            return None  # Only LC0 layer and motor arguments
+        rest = body[4:] if not body[3] & 0x80 else body[5:] if body[3] == 0x81 else None
+        if rest is None:
+            return None
+        if rest and rest != bytes([cls.opOUTPUT_START, layer, motors]):
+            return None
+        return layer, motors, bool(rest)
+
+    @classmethod
+    def parse_reply(cls, data):
+        """Parse EV3 reply message"""
+        if len(data) < 5:
+            return None
+
+        reply_size, msg_counter, reply_type = cls._REPLY_HEADER.unpack_from(data)
+        return {
+            'size': reply_size,
+            'counter': msg_counter,
+            'type': reply_type,
+            'payload': bytes(data[5:])
+        }
+
+
+class EV3FrameReassembler:
+    """Split a raw Bluetooth byte stream into complete EV3 frames
+
+    Every EV3 message starts with a 2-byte little endian length that counts
+    the bytes following it. RFCOMM does not keep message boundaries, so a
+    single read can hold half a reply or several replies glued together.
+    """
+
+    LENGTH = struct.Struct('<H')
+
+    def __init__(self):
+        self.buffer = bytearray()  # Reused for the life of the connection
+
+    def reset(self):
+        """Drop any partial frame (e.g. after reconnect)"""
+        self.buffer.clear()
+
+    def pending(self):
+        """Number of buffered bytes not yet returned as a frame"""
+        return len(self.buffer)
+
+    def feed(self, data):
+        """Add received bytes, return a list of complete frames (bytes)"""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+        while end - offset >= 2:
+            size = self.LENGTH.unpack_from(buffer, offset)[0] + 2
+            if end - offset < size:
+                break
+            frames.append(bytes(buffer[offset:offset + size]))
+            offset += size
+
+        # Drop consumed bytes once per read; only a partial frame stays behind
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def feed_views(self, data, handler):
+        """Like feed(), but call handler(memoryview) per frame without copying
+
+        The view is only valid during the call. With nothing buffered,
+        frames are sliced straight out of data and only a trailing partial
+        frame is copied. Returns the number of frames handled.
+        """
+        buffer = self.buffer
+        if buffer:
+            buffer += data
+            source = buffer
+        else:
+            source = data
+        count = 0
+        offset = 0
+        end = len(source)
+        with memoryview(source) as view:
+            while end - offset >= 2:
+                size = self.LENGTH.unpack_from(view, offset)[0] + 2
+                if end - offset < size:
+                    break
+                with view[offset:offset + size] as frame:
+                    handler(frame)
+                offset += size
+                count += 1
+            if source is not buffer and offset < end:
+                buffer += view[offset:]
+
+        if source is buffer and offset:
+            del buffer[:offset]
+        return count
+
+
+class EV3RequestTracker:
+    """Match EV3 replies to outstanding requests by message counter
+
+    The counter is 16 bits and wraps, so it is only unique among requests
+    in flight. A request still waiting when its counter comes around again
+    is failed rather than receiving someone else's reply.
+
+    Each request carries the EV3ReplyLayout its reply is decoded with,
+    given to track() or looked up in the decoder registry by the request's
+    command type and opcode (see register()). Decoded values are delivered
+    as reply['values'], so callbacks never guess at payload shapes.
+    """
+
+    COUNTER = struct.Struct('<H')
+    GLOBALS = struct.Struct('<H')  # Variable allocation of direct commands
+
+    # Offset of the first opcode, and of reply values behind it
+    DIRECT_OPCODE = 7  # Length, counter, type, variable allocation
+    SYSTEM_OPCODE = 5  # Length, counter, type
+    SYSTEM_VALUES = 2  # System replies start with command echo and status
+    SYSTEM_OK = (EV3Protocol.SUCCESS, EV3Protocol.END_OF_FILE)  # Transfer done is no error
+
+    def __init__(self, timeout=2.0, clock=time.monotonic):
+        self.timeout = timeout  # Default seconds to wait for a reply
+        self.clock = clock
+        self.in_flight = {}  # counter -> (deadline, callback, layout)
+        handle = EV3ReplyLayout.get(('uint8',))
+        size_handle = EV3ReplyLayout.get(('uint32', 'uint8'))  # Data follows
+        system = EV3Protocol.SYSTEM_COMMAND_REPLY
+        self.decoders = {
+            # Sensor reads: one float per 4 bytes of global variables
+            (EV3Protocol.DIRECT_COMMAND_REPLY, EV3Protocol.opINPUT_DEVICE):
+                lambda message: EV3ReplyLayout.floats(self.global_size(message) // 4),
+            (system, EV3Protocol.BEGIN_DOWNLOAD): lambda message: handle,
+            (system, EV3Protocol.CONTINUE_DOWNLOAD): lambda message: handle,
+            (system, EV3Protocol.BEGIN_UPLOAD): lambda message: size_handle,
+            (system, EV3Protocol.CONTINUE_UPLOAD): lambda message: handle,
+            (system, EV3Protocol.LIST_FILES): lambda message: size_handle,
+            (system, EV3Protocol.CONTINUE_LIST_FILES): lambda message: handle,
+        }
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def __contains__(self, counter):
+        return counter in self.in_flight
+
+    def register(self, cmd_type, opcode, layout_for):
+        """Decode replies to (cmd_type, opcode) requests with layout_for(message)
+
+        cmd_type is DIRECT_COMMAND_REPLY or SYSTEM_COMMAND_REPLY, opcode the
+        first direct opcode or the system command. layout_for returns an
+        EV3ReplyLayout, or None to deliver the raw payload only.
+        """
+        self.decoders[(cmd_type, opcode)] = layout_for
+
+    @staticmethod
+    def expects_reply(message):
+        """True if the message is a *_COMMAND_REPLY type"""
+        return len(message) > 4 and not message[4] & 0x80
+
+    @classmethod
+    def global_size(cls, message):
+        """Bytes of global variables a direct command allocates"""
+        return cls.GLOBALS.unpack_from(message, 5)[0] & 0x3FF
+
+    def layout_for(self, message):
+        """Registered reply layout for a built message, or None"""
+        cmd_type = message[4] & 0x7F
+        offset = self.SYSTEM_OPCODE if cmd_type == EV3Protocol.SYSTEM_COMMAND_REPLY else self.DIRECT_OPCODE
+        if len(message) <= offset:
+            return None
+        decoder = self.decoders.get((cmd_type, message[offset]))
+        return decoder(message) if decoder else None
+
+    def track(self, message, callback, timeout=None, layout=None):
+        """Register a built message; callback(reply, error) is called once
+
+        reply is the parse_reply() dict plus 'values' (decoded with layout,
+        or the registered one; None without a layout) and for system
+        replies 'status', error a string on timeout, counter reuse, an
+        error reply, a system status other than SUCCESS or END_OF_FILE or a
+        short payload. Messages
+        that do not expect a reply are ignored. Returns the message counter,
+        or None if nothing was tracked.
+        """
+        if not self.expects_reply(message):
+            return None
+        counter = self.COUNTER.unpack_from(message, 2)[0]
+        previous = self.in_flight.pop(counter, None)
+        if previous:
+            previous[1](None, f"Counter {counter} reused before reply")
+        if timeout is None:
+            timeout = self.timeout
+        if layout is None:
+            layout = self.layout_for(message)
+        self.in_flight[counter] = (self.clock() + timeout, callback, layout)
+        return counter
+
+    def resolve(self, reply):
+        """Decode and deliver a parsed reply, return True if it matched a request"""
+        entry = self.in_flight.pop(reply['counter'], None)
+        if entry is None:
+            return False
+        _, callback, layout = entry
+        reply['values'] = None
+        reply_type = reply['type']
+        payload = reply['payload']
+        if reply_type in (EV3Protocol.SYSTEM_REPLY, EV3Protocol.SYSTEM_REPLY_ERROR):
+            reply['status'] = payload[1] if len(payload) > 1 else None
+        if reply_type == EV3Protocol.DIRECT_REPLY:
+            offset = 0
+        elif reply_type == EV3Protocol.SYSTEM_REPLY and reply['status'] in self.SYSTEM_OK:
+            offset = self.SYSTEM_VALUES
+        else:
+            name = EV3Protocol.REPLY_NAMES.get(reply_type, f"type 0x{reply_type:02X}")
+            error = f"{name} for counter {reply['counter']}"
+            if reply.get('status') is not None:
+                status = reply['status']
+                error += f": {EV3Protocol.SYSTEM_STATUS_NAMES.get(status, f'status 0x{status:02X}')}"
+            callback(reply, error)
+            return True
+        if layout is not None:
+            try:
+                reply['values'] = layout.decode(reply['payload'], offset)
+            except ValueError as error:
+                callback(reply, str(error))
+                return True
+        callback(reply, None)
+        return True
+
+    def expire(self):
+        """Fail requests whose deadline has passed, return how many"""
+        now = self.clock()
+        expired = [counter for counter, (deadline, _, _) in self.in_flight.items()
+                   if deadline <= now]
+        for counter in expired:
+            callback = self.in_flight.pop(counter)[1]
+            callback(None, f"No reply for counter {counter}")
+        return len(expired)
+
+    def next_deadline(self):
+        """Earliest deadline among requests in flight, or None"""
+        if not self.in_flight:
+            return None
+        return min(entry[0] for entry in self.in_flight.values())
+
+    def cancel_all(self, error="Connection closed"):
+        """Fail every request in flight (e.g. on disconnect)"""
+        in_flight = self.in_flight
+        self.in_flight = {}
+        for _, callback, _ in in_flight.values():
+            callback(None, error)
+
+
+class EV3Mailboxes:
+    """Typed messages from brick program mailboxes, delivered per name
+
+    feed() takes every reassembled frame and consumes the WRITEMAILBOX
+    ones. Each is decoded in place with the kind its mailbox was
+    subscribed with ('text', 'number', 'bool' or 'raw') and passed on as
+    callback(name, value). Subscribing to name None receives every
+    mailbox, decoded as 'auto': text if zero terminated, bool for one
+    byte, number for four, else raw; good for display only.
+    """
+
+    HEADER = struct.Struct('<HHBBB')  # Length, counter, type, command, name size
+    SIZE = struct.Struct('<H')
+    NUMBER = struct.Struct('<f')
+
+    def __init__(self):
+        self.subscriptions = {}  # Encoded name or None -> (kind, [callbacks])
+        self.names = {}  # Encoded name -> str, decoded once
+        self.malformed = 0  # Mailbox frames too short for their sizes
+
+    def subscribe(self, name, callback, kind='text'):
+        """Call callback(name, value) for each message to mailbox name"""
+        if kind not in self.DECODERS:
+            raise ValueError(f"Unknown mailbox kind: {kind}")
+        key = None if name is None else name.encode('utf-8')
+        entry = self.subscriptions.get(key)
+        if entry is None or entry[0] != kind:
+            entry = self.subscriptions[key] = (kind, [])
+        entry[1].append(callback)
+
+    def unsubscribe(self, name, callback):
+        """Stop calling callback for mailbox name"""
+        key = None if name is None else name.encode('utf-8')
+        entry = self.subscriptions.get(key)
+        if entry and callback in entry[1]:
+            entry[1].remove(callback)
+            if not entry[1]:
+                del self.subscriptions[key]
+
+    @staticmethod
+    def is_mailbox(frame):
+        """True if frame is a WRITEMAILBOX system command"""
+        return (len(frame) > 6 and frame[5] == EV3Protocol.WRITEMAILBOX and
+                frame[4] & 0x7F == EV3Protocol.SYSTEM_COMMAND_REPLY)
+
+    def feed(self, frame):
+        """Deliver a WRITEMAILBOX frame, return False for any other frame"""
+        if not self.is_mailbox(frame):
+            return False
+        name_size = frame[6]
+        start = 9 + name_size  # Value follows name and its 2 byte size
+        if len(frame) < start:
+            self.malformed += 1
+            return True
+        key = bytes(frame[7:6 + name_size])  # Without the terminator
+        size = self.SIZE.unpack_from(frame, 7 + name_size)[0]
+        if len(frame) < start + size:
+            self.malformed += 1
+            return True
+
+        subscriptions = self.subscriptions
+        entries = [entry for entry in (subscriptions.get(key), subscriptions.get(None)) if entry]
+        if not entries:
+            return True
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = key.decode('utf-8', 'replace')
+        for kind, callbacks in entries:
+            value = self.DECODERS[kind](self, frame, start, size)
+            for callback in callbacks:
+                callback(name, value)
+        return True
+
+    def decode_text(self, frame, start, size):
+        """Text up to the zero terminator"""
+        return bytes(frame[start:start + size]).split(b'\x00', 1)[0].decode('utf-8', 'replace')
+
+    def decode_number(self, frame, start, size):
+        """4 byte float, NaN if the message is too short"""
+        return self.NUMBER.unpack_from(frame, start)[0] if size >= 4 else float('nan')
+
+    def decode_bool(self, frame, start, size):
+        """Logic value, any nonzero byte is True"""
+        return size > 0 and frame[start] != 0
+
+    def decode_raw(self, frame, start, size):
+        """Payload bytes as sent"""
+        return bytes(frame[start:start + size])
+
+    def decode_auto(self, frame, start, size):
+        """Best guess of the kind, for display"""
+        if size and frame[start + size - 1] == 0:
+            return self.decode_text(frame, start, size)
+        if size == 1:
+            return self.decode_bool(frame, start, size)
+        if size == 4:
+            return self.decode_number(frame, start, size)
+        return self.decode_raw(frame, start, size)
+
+    DECODERS = {
+        'text': decode_text,
+        'number': decode_number,
+        'bool': decode_bool,
+        'raw': decode_raw,
+        'auto': decode_auto,
+    }
+
+
+class EV3MotorScheduler:
+    """Latest-value-wins motor commands, flushed at a fixed control rate
+
+    set_speed() and stop() only record the wanted state per output port
+    (A-D). flush(), called from a timer, sends one command per group of
+    ports with the same new state, so intermediate speeds never reach the
+    Bluetooth link and a stale command can not queue behind a fresh one.
+    """
+
+    PORTS = (0x01, 0x02, 0x04, 0x08)  # Motor bits of ports A-D
+
+    def __init__(self, protocol, write):
+        self.protocol = protocol
+        self.write = write  # write(message) sends a built message
+        self.pending = {}  # port bit -> ('speed', speed) or ('stop', brake)
+        self.sent = {}  # port bit -> last state written
+
+    def set_speed(self, motor_bits, speed):
+        """Run motors at speed (-100 to 100) from the next flush"""
+        self._set(motor_bits, ('speed', speed))
+
+    def stop(self, motor_bits, brake=True):
+        """Stop motors at the next flush"""
+        self._set(motor_bits, ('stop', bool(brake)))
+
+    def _set(self, motor_bits, state):
+        for port in self.PORTS:
+            if motor_bits & port:
+                if self.sent.get(port) == state:
+                    self.pending.pop(port, None)  # Back to what the brick has
+                else:
+                    self.pending[port] = state
+
+    def reset(self):
+        """Forget pending and sent state (e.g. after reconnect)"""
+        self.pending.clear()
+        self.sent.clear()
+
+    def resend(self):
+        """Send the whole wanted state again at the next flush
+
+        For a link that dropped and is coming back: the last writes may
+        never have reached the brick. Newer pending states still win.
+        """
+        for port, state in self.sent.items():
+            self.pending.setdefault(port, state)
+        self.sent.clear()
+
+    def flush(self):
+        """Send the pending state, return the number of messages written"""
+        if not self.pending:
+            return 0
+        groups = {}  # state -> combined motor bits
+        for port, state in self.pending.items():
+            groups[state] = groups.get(state, 0) | port
+        self.sent.update(self.pending)
+        self.pending.clear()
+
+        for (kind, value), motor_bits in groups.items():
+            if kind == 'speed':
+                self.write(self.protocol.start_motor(motor_bits, value))
+            else:
+                self.write(self.protocol.stop_motor(motor_bits, brake=value))
+        return len(groups)
+
+
+class EV3SensorPoller:
+    """Batched polling of a fixed sensor set, reporting only changed values
+
+    Values within deadband of the last reported value count as unchanged.
+    """
+
+    def __init__(self, protocol, reads, deadband=0.0):
+        self.protocol = protocol
+        self.reads = [tuple(read) for read in reads]  # (port, mode) pairs
+        if len(self.reads) > protocol.MAX_BATCH_READS:
+            raise ValueError(f"At most {protocol.MAX_BATCH_READS} sensors per subscription")
+        self.deadband = deadband
+        self.last = [None] * len(self.reads)  # Last reported values
+
+    def build(self):
+        """Direct command reading every sensor in one round trip"""
+        return self.protocol.read_sensors(self.reads)
+
+    def changes(self, values):
+        """Given the decoded reply values, return [(port, mode, value)] that changed"""
+        changed = []
+        last = self.last
+        for index, value in enumerate(values):
+            previous = last[index]
+            if value != value or previous != previous:
+                # NaN (no sensor attached) only counts when it starts or stops
+                report = (value != value) != (previous != previous)
+            else:
+                report = previous is None or abs(value - previous) > self.deadband
+            if report:
+                last[index] = value
+                port, mode = self.reads[index]
+                changed.append((port, mode, value))
+        return changed
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+EV3 file transfer: push files to one or more bricks and list directories
+The transfer classes are transport independent: they send through a
+write(message) callback and get replies from an EV3RequestTracker the
+transport feeds. The CLI drives them over raw RFCOMM sockets (Linux),
+one link per brick, all bricks in parallel.
+
+  ./ev3transfer.py push -b 00:16:53:AA:BB:CC -b 00:16:53:DD:EE:FF \\
+      beep.rsf demo.rbf --to ../prjs/Demo/
+  ./ev3transfer.py ls -b 00:16:53:AA:BB:CC ../prjs/Demo/
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import hashlib
+import argparse
+
+from ev3protocol import EV3Protocol, EV3FrameReassembler, EV3RequestTracker
+
+
+# The EV3 exposes its Serial Port Profile on RFCOMM channel 1
+DEFAULT_RFCOMM_CHANNEL = 1
+
+
+class EV3Download:
+    """Write one local file to the brick (BEGIN/CONTINUE_DOWNLOAD)
+
+    After BEGIN_DOWNLOAD opens the file, up to window CONTINUE_DOWNLOAD
+    frames are in flight at once. The file is read from disk one chunk at
+    a time as replies free up the window. progress(acked, size) is called
+    after every acknowledged chunk, on_done(error) exactly once.
+    """
+
+    def __init__(self, protocol, requests, write, source, target,
+                 chunk_size=EV3Protocol.MAX_DOWNLOAD_CHUNK, window=4,
+                 on_done=None, progress=None, clock=time.monotonic):
+        if not 0 < chunk_size <= EV3Protocol.MAX_DOWNLOAD_CHUNK:
+            raise ValueError(f"Chunk size must be 1-{EV3Protocol.MAX_DOWNLOAD_CHUNK}")
+        self.protocol = protocol
+        self.requests = requests
+        self.write = write
+        self.source = source
+        self.target = target  # Path on the brick
+        self.chunk_size = chunk_size
+        self.window = max(1, window)
+        self.on_done = on_done
+        self.progress = progress
+        self.clock = clock
+
+        self.size = os.path.getsize(source)
+        self.file = None
+        self.handle = None  # Brick file handle from BEGIN_DOWNLOAD
+        self.sent = 0  # Bytes read from disk and sent
+        self.acked = 0  # Bytes the brick confirmed
+        self.in_flight = 0
+        self.started = self.finished = None
+        self.error = None
+        self.done = False
+
+    def start(self):
+        """Open the local file and send BEGIN_DOWNLOAD"""
+        self.file = open(self.source, 'rb')
+        self.started = self.clock()
+        self.send(self.protocol.begin_download(self.size, self.target), self.on_begin)
+
+    def send(self, message, callback):
+        """Track and write one system command"""
+        self.requests.track(message, callback)
+        self.write(message)
+
+    def on_begin(self, reply, error):
+        """BEGIN_DOWNLOAD reply: keep the handle, fill the window"""
+        if error:
+            self.finish(f"BEGIN_DOWNLOAD {self.target}: {error}")
+            return
+        self.handle, = reply['values']
+        if self.size:
+            self.fill_window()
+        else:
+            self.finish(None)
+
+    def fill_window(self):
+        """Send chunks until window frames are in flight or the file is sent"""
+        while self.in_flight < self.window and self.sent < self.size:
+            data = self.file.read(self.chunk_size)
+            if not data:
+                self.finish(f"{self.source} shrank while sending")
+                return
+            self.sent += len(data)
+            self.in_flight += 1
+            self.send(self.protocol.continue_download(self.handle, data),
+                      lambda reply, error, size=len(data): self.on_chunk(size, reply, error))
+
+    def on_chunk(self, size, reply, error):
+        """CONTINUE_DOWNLOAD reply: count the chunk, send more"""
+        self.in_flight -= 1
+        if self.done:
+            return  # Failed already, later replies do not matter
+        if error:
+            self.finish(f"CONTINUE_DOWNLOAD {self.target}: {error}")
+            return
+        self.acked += size
+        if self.progress:
+            self.progress(self.acked, self.size)
+        if self.acked >= self.size:
+            self.finish(None)
+        else:
+            self.fill_window()
+
+    def finish(self, error):
+        """Close the local file, free the brick's handle on error, report"""
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        self.finished = self.clock()
+        if self.file:
+            self.file.close()
+        if error and self.handle is not None:
+            # Best effort, a dead link just fails this request too
+            self.send(self.protocol.close_file_handle(self.handle), lambda reply, error: None)
+        if self.on_done:
+            self.on_done(error)
+
+    def throughput(self):
+        """Acknowledged bytes per second so far"""
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or self.clock()) - self.started
+        return self.acked / elapsed if elapsed > 0 else 0.0
+
+
+class EV3FileList:
+    """Read a directory listing (LIST_FILES / CONTINUE_LIST_FILES)
+
+    on_done(entries, error) gets {name: (size, md5)} for files and
+    {name/: None} for directories.
+    """
+
+    # Reply space after counter, type, command, status, size and handle
+    CHUNK = EV3Protocol.MAX_MESSAGE - 10
+
+    def __init__(self, protocol, requests, write, path, on_done):
+        self.protocol = protocol
+        self.requests = requests
+        self.write = write
+        self.path = path
+        self.on_done = on_done
+        self.data = bytearray()
+        self.size = 0
+        self.handle = None
+
+    def start(self):
+        """Send LIST_FILES"""
+        self.send(self.protocol.list_files(self.path, self.CHUNK), self.on_begin)
+
+    def send(self, message, callback):
+        """Track and write one system command"""
+        self.requests.track(message, callback)
+        self.write(message)
+
+    def on_begin(self, reply, error):
+        """LIST_FILES reply: listing size, handle and the first bytes"""
+        if error:
+            self.on_done(None, f"LIST_FILES {self.path}: {error}")
+            return
+        self.size, self.handle = reply['values']
+        self.data += reply['payload'][7:]  # Echo, status, size, handle
+        self.next(reply)
+
+    def on_continue(self, reply, error):
+        """CONTINUE_LIST_FILES reply: the next bytes"""
+        if error:
+            self.on_done(None, f"CONTINUE_LIST_FILES {self.path}: {error}")
+            return
+        self.data += reply['payload'][3:]  # Echo, status, handle
+        self.next(reply)
+
+    def next(self, reply):
+        """Ask for more or report the parsed listing"""
+        if len(self.data) < self.size and reply['status'] != EV3Protocol.END_OF_FILE:
+            self.send(self.protocol.continue_list_files(self.handle, self.CHUNK),
+                      self.on_continue)
+        else:
+            self.on_done(self.parse(self.data), None)
+
+    @staticmethod
+    def parse(data):
+        """Listing text to {name: (size, md5) or None for directories}"""
+        entries = {}
+        for line in bytes(data).decode('utf-8', 'replace').splitlines():
+            if line.endswith('/'):
+                entries[line] = None
+                continue
+            # 32 hex digit MD5, 8 hex digit size, name
+            parts = line.split(' ', 2)
+            if len(parts) == 3:
+                md5, size, name = parts
+                entries[name] = (int(size, 16), md5.lower())
+        return entries
+
+
+def file_md5(path, chunk_size=65536):
+    """Hex MD5 of a local file, read in chunks"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as source:
+        while chunk := source.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EV3Push:
+    """Push several files into one brick directory, resumable
+
+    With resume on, the directory is listed first and files whose size
+    and MD5 already match are skipped, so a batch that broke off can be
+    run again. A file that fails is sent again from its first byte, up to
+    retries times (the brick cannot continue a download at an offset).
+    on_file(source, download, error) is called per file (download None if
+    skipped, or if the local file could not be read), on_done(failed) once
+    with the number of failed files.
+    """
+
+    def __init__(self, protocol, requests, write, sources, target_dir, retries=2,
+                 resume=True, on_file=None, on_done=None, **download_options):
+        self.protocol = protocol
+        self.requests = requests
+        self.write = write
+        self.sources = list(sources)
+        self.target_dir = target_dir if target_dir.endswith('/') else target_dir + '/'
+        self.retries = retries
+        self.resume = resume
+        self.on_file = on_file
+        self.on_done = on_done
+        self.download_options = download_options  # chunk_size, window, progress
+        self.remote = {}  # Listing of target_dir when resuming
+        self.index = 0
+        self.attempt = 0
+        self.failed = 0
+
+    def start(self):
+        """List the target directory (when resuming), then send files"""
+        if self.resume:
+            EV3FileList(self.protocol, self.requests, self.write, self.target_dir,
+                        self.on_listing).start()
+        else:
+            self.next_file()
+
+    def on_listing(self, entries, error):
+        """Remember what the brick has; a missing directory is created"""
+        if error:
+            message = self.protocol.create_dir(self.target_dir.rstrip('/'))
+            self.requests.track(message, lambda reply, error: None)
+            self.write(message)
+        self.remote = entries or {}
+        self.next_file()
+
+    def is_current(self, source):
+        """True if the brick already holds this exact file"""
+        entry = self.remote.get(os.path.basename(source))
+        try:
+            return (entry is not None and entry[0] == os.path.getsize(source) and
+                    entry[1] == file_md5(source))
+        except OSError:
+            return False  # Sending reports the error
+
+    def next_file(self):
+        """Start the next file that is not on the brick yet"""
+        while self.index < len(self.sources):
+            source = self.sources[self.index]
+            if not (self.resume and self.is_current(source)):
+                self.attempt = 0
+                self.send_file(source)
+                return
+            if self.on_file:
+                self.on_file(source, None, None)
+            self.index += 1
+        if self.on_done:
+            self.on_done(self.failed)
+
+    def send_file(self, source):
+        """One download attempt of source"""
+        self.attempt += 1
+        try:
+            download = EV3Download(self.protocol, self.requests, self.write, source,
+                                   self.target_dir + os.path.basename(source),
+                                   on_done=lambda error: self.on_file_done(source, download, error),
+                                   **self.download_options)
+            download.start()
+        except OSError as error:
+            self.on_file_done(source, None, str(error))  # Local file, no point retrying
+
+    def on_file_done(self, source, download, error):
+        """Retry a failed transfer, else move on"""
+        if error and download and self.attempt <= self.retries:
+            self.send_file(source)
+            return
+        if error:
+            self.failed += 1
+        if self.on_file:
+            self.on_file(source, download, error)
+        self.index += 1
+        self.next_file()
+
+
+class RfcommLink:
+    """Raw RFCOMM connection to one brick, replies fed to a tracker"""
+
+    def __init__(self, address, channel=DEFAULT_RFCOMM_CHANNEL, timeout=5.0):
+        self.address = address
+        self.channel = channel
+        self.protocol = EV3Protocol()
+        self.requests = EV3RequestTracker(timeout)
+        self.reassembler = EV3FrameReassembler()
+        self.writer = None
+        self.tasks = []
+
+    async def open(self):
+        """Connect and start reading replies"""
+        bt_socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
+                                  socket.BTPROTO_RFCOMM)
+        bt_socket.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(bt_socket, (self.address, self.channel))
+        except OSError:
+            bt_socket.close()
+            raise
+        reader, self.writer = await asyncio.open_connection(sock=bt_socket)
+        self.tasks = [asyncio.create_task(self.read_loop(reader)),
+                      asyncio.create_task(self.expire_loop())]
+
+    def write(self, message):
+        """Queue a message for the brick"""
+        self.writer.write(message)
+
+    async def read_loop(self, reader):
+        """Resolve requests as replies arrive"""
+        try:
+            while data := await reader.read(4096):
+                for frame in self.reassembler.feed(data):
+                    reply = EV3Protocol.parse_reply(frame)
+                    if reply:
+                        self.requests.resolve(reply)
+        except OSError:
+            pass
+        self.requests.cancel_all()
+
+    async def expire_loop(self):
+        """Fail requests whose reply never arrives"""
+        while True:
+            await asyncio.sleep(0.25)
+            self.requests.expire()
+
+    async def close(self):
+        """Stop the tasks and drop the connection"""
+        for task in self.tasks:
+            task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+async def run_push(address, args):
+    """Push args.files to one brick, return the number of failed files"""
+    link = RfcommLink(address, args.channel)
+    try:
+        await link.open()
+    except OSError as error:
+        print(f"{address}: connection failed: {error}")
+        return len(args.files)
+
+    done = asyncio.get_running_loop().create_future()
+    started = time.monotonic()
+    total = 0
+
+    def on_file(source, download, error):
+        nonlocal total
+        name = os.path.basename(source)
+        if error:
+            print(f"{address}: {name}: failed: {error}")
+        elif download is None:
+            print(f"{address}: {name}: already on the brick, skipped")
+        else:
+            total += download.acked
+            print(f"{address}: {name}: {download.acked} bytes in "
+                  f"{download.finished - download.started:.2f} s "
+                  f"({download.throughput() / 1024:.1f} KiB/s)")
+
+    push = EV3Push(link.protocol, link.requests, link.write, args.files, args.to,
+                   retries=args.retries, resume=not args.force, on_file=on_file,
+                   on_done=done.set_result, chunk_size=args.chunk, window=args.window)
+    push.start()
+    failed = await done
+    elapsed = time.monotonic() - started
+    print(f"{address}: {total} bytes in {elapsed:.2f} s "
+          f"({total / elapsed / 1024 if elapsed else 0:.1f} KiB/s), {failed} failed")
+    await link.close()
+    return failed
+
+
+async def run_ls(address, args):
+    """Print one brick's listing of args.path, return 1 on error"""
+    link = RfcommLink(address, args.channel)
+    try:
+        await link.open()
+    except OSError as error:
+        print(f"{address}: connection failed: {error}")
+        return 1
+    done = asyncio.get_running_loop().create_future()
+    EV3FileList(link.protocol, link.requests, link.write, args.path,
+                lambda entries, error: done.set_result((entries, error))).start()
+    entries, error = await done
+    await link.close()
+    if error:
+        print(f"{address}: {error}")
+        return 1
+    for name, entry in sorted(entries.items()):
+        if entry is None:
+            print(f"{address}: {name}")
+        else:
+            print(f"{address}: {name:<32} {entry[0]:>9} {entry[1]}")
+    return 0
+
+
+async def run_all(command, args):
+    """Run command against every brick at once"""
+    results = await asyncio.gather(*(command(address, args) for address in args.brick))
+    return sum(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EV3 file transfer over Bluetooth RFCOMM")
+    parser.add_argument('-b', '--brick', action='append', required=True,
+                        help="brick address (repeat for several bricks)")
+    parser.add_argument('--channel', type=int, default=DEFAULT_RFCOMM_CHANNEL,
+                        help="RFCOMM channel (default 1)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    push = commands.add_parser('push', help="write files to the bricks")
+    push.add_argument('files', nargs='+', help="local files")
+    push.add_argument('--to', required=True, help="directory on the brick, e.g. ../prjs/Demo/")
+    push.add_argument('--window', type=int, default=4,
+                      help="CONTINUE_DOWNLOAD frames in flight (default 4)")
+    push.add_argument('--chunk', type=int, default=EV3Protocol.MAX_DOWNLOAD_CHUNK,
+                      help=f"bytes per frame (default {EV3Protocol.MAX_DOWNLOAD_CHUNK})")
+    push.add_argument('--retries', type=int, default=2, help="attempts per file after the first")
+    push.add_argument('--force', action='store_true',
+                      help="send every file, even if the brick already has it")
+
+    ls = commands.add_parser('ls', help="list a directory on the bricks")
+    ls.add_argument('path', help="directory on the brick, e.g. ../prjs/")
+
+    args = parser.parse_args()
+    command = run_push if args.command == 'push' else run_ls
+    try:
+        failed = asyncio.run(run_all(command, args))
+    except KeyboardInterrupt:
+        failed = 1
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Logging setup shared by the Scratch Link servers
+Records go through a queue to a listener thread, so the event loop never
+blocks on stdout, and each category (logger name) is rate limited.
+Also the --startup-report printout both servers share
+"""
+
+import sys
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most rate records per category through every per seconds
+
+    Errors always pass. The first record of a new window reports how
+    many were dropped in the previous one; for a category that went quiet
+    sweep() hands a summary record to emit(), checked once per window
+    while anything logs and at exit.
+    """
+
+    def __init__(self, rate=20, per=1.0, clock=time.monotonic, emit=None):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.clock = clock
+        self.emit = emit  # emit(record) past this filter, for summaries
+        self.swept = clock()
+        self.windows = {}  # logger name -> [window start, passed, suppressed, max level]
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        now = self.clock()
+        if now - self.swept >= self.per:
+            self.sweep(now)
+        window = self.windows.get(record.name)
+        if window is None or now - window[0] >= self.per:
+            suppressed = window[2] if window else 0
+            self.windows[record.name] = [now, 1, 0, 0]
+            if suppressed:
+                record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+            return True
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        window[3] = max(window[3], record.levelno)
+        return False
+
+    def sweep(self, now=None):
+        """Emit suppressed counts of ended windows, of all windows if now is None"""
+        self.swept = self.clock() if now is None else now
+        if self.emit is None:
+            return
+        for name, window in list(self.windows.items()):
+            if window[2] and (now is None or now - window[0] >= self.per):
+                self.emit(logging.LogRecord(name, window[3], __file__, 0,
+                                            "[%d similar messages suppressed]", (window[2],),
+                                            None))
+                window[2] = 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread
+
+    Callers must pass immutable arguments (str, int, bytes, ...), as they
+    are formatted later.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(debug=False, rate=20, per=1.0):
+    """Log to stdout through a background thread, return the listener
+
+    In debug mode everything down to DEBUG (hex traces) is logged and
+    nothing is rate limited.
+    """
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    rate_limit = None
+    if not debug:
+        rate_limit = RateLimitFilter(rate, per, emit=handler.emit)
+        handler.addFilter(rate_limit)
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    if rate_limit:
+        atexit.register(rate_limit.sweep)  # Runs first, the listener still writes
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+    return listener
+
+
+def report_startup(startup):
+    """Print time spent in each startup phase and the peak RSS
+
+    startup is a list of (phase, time.perf_counter()) pairs, the first
+    one taken when the process started.
+    """
+    import resource
+
+    previous = startup[0][1]
+    for phase, stamp in startup[1:]:
+        print(f"  {phase:<16} {(stamp - previous) * 1000:8.1f} ms")
+        previous = stamp
+    print(f"  {'total':<16} {(previous - startup[0][1]) * 1000:8.1f} ms")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"  {'peak rss':<16} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:8.1f} MB")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Bounded log widget for the SPP GUI tools
+Keeps the last lines in a ring buffer, shows them in a QPlainTextEdit
+capped with setMaximumBlockCount and appends in batches on a timer
+"""
+
+from collections import deque
+
+from PyQt6.QtCore import QTimer
+from PyQt6.QtWidgets import QComboBox, QPlainTextEdit, QVBoxLayout, QWidget
+
+
+class LogView(QWidget):
+    """Append-only log view with a fixed line budget and kind filter"""
+
+    KINDS = ('info', 'sent', 'received', 'error')
+
+    def __init__(self, max_lines=5000, refresh_ms=100, filters=True, parent=None):
+        super().__init__(parent)
+        self.entries = deque(maxlen=max_lines)  # (kind, line), newest last
+        self.pending = deque(maxlen=max_lines)  # Lines shown at the next refresh
+        self.shown_kinds = set(self.KINDS)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        if filters:
+            self.filter_combo = QComboBox()
+            self.filter_combo.addItem("All")
+            self.filter_combo.addItems([kind.capitalize() for kind in self.KINDS])
+            self.filter_combo.currentIndexChanged.connect(self.on_filter_changed)
+            layout.addWidget(self.filter_combo)
+
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setMaximumBlockCount(max_lines)  # Oldest lines drop off
+        layout.addWidget(self.text)
+
+        # One widget update per refresh interval, not one per line
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(refresh_ms)
+        self.refresh_timer.timeout.connect(self.flush)
+
+    def append(self, line, kind='info'):
+        """Add a line; it shows up at the next refresh"""
+        self.entries.append((kind, line))
+        if kind in self.shown_kinds:
+            self.pending.append(line)
+            if not self.refresh_timer.isActive():
+                self.refresh_timer.start()
+
+    def flush(self):
+        """Show all pending lines with a single append"""
+        if self.pending:
+            self.text.appendPlainText('\n'.join(self.pending))
+            self.pending.clear()
+
+    def clear(self):
+        """Forget every line"""
+        self.entries.clear()
+        self.pending.clear()
+        self.text.clear()
+
+    def on_filter_changed(self, index):
+        """Show all kinds (index 0) or a single one, rebuilt from the buffer"""
+        self.shown_kinds = set(self.KINDS) if index == 0 else {self.KINDS[index - 1]}
+        self.pending.clear()
+        self.text.setPlainText('\n'.join(line for kind, line in self.entries
+                                         if kind in self.shown_kinds))
+        self.text.moveCursor(self.text.textCursor().MoveOperation.End)
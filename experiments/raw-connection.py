@@ -3,11 +3,14 @@
 import sys
 import struct
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
-                             QHBoxLayout, QPushButton, QTextEdit, QLineEdit,
+                             QHBoxLayout, QPushButton, QLineEdit,
                              QLabel, QComboBox, QMessageBox)
 from PyQt6.QtCore import pyqtSignal
-from PyQt6.QtBluetooth import (QBluetoothDeviceDiscoveryAgent, QBluetoothSocket,
-                               QBluetoothAddress, QBluetoothUuid, QBluetoothServiceInfo)
+from PyQt6.QtBluetooth import QBluetoothDeviceDiscoveryAgent
+
+from logview import LogView
+from sppworker import SPPWorker
+from devicestore import DeviceRegistry, class_of_device, default_registry_path
 
 
 class EV3Protocol:
@@ -166,10 +169,17 @@ class EV3Protocol:
 
 
 class SPPBluetoothApp(QMainWindow):
+    # Requests to the worker thread (queued connections)
+    connect_requested = pyqtSignal(str)
+    disconnect_requested = pyqtSignal()
+    send_requested = pyqtSignal(str)
+    stop_requested = pyqtSignal()
+
     def __init__(self):
         super().__init__()
-        self.socket = None
+        self.is_connected = False
         self.devices = {}  # Store device addresses with names
+        self.registry = DeviceRegistry(default_registry_path())  # Devices seen before
 
         # Create discovery agent in main thread
         self.discovery_agent = QBluetoothDeviceDiscoveryAgent()
@@ -178,6 +188,20 @@ class SPPBluetoothApp(QMainWindow):
         self.discovery_agent.errorOccurred.connect(self.on_scan_error)
 
         self.init_ui()
+        self.add_known_devices()
+
+        # Socket I/O runs in its own thread, so painting never delays reads
+        self.worker = SPPWorker()
+        self.worker.connected.connect(self.on_connected)
+        self.worker.interrupted.connect(self.on_interrupted)
+        self.worker.disconnected.connect(self.on_disconnected)
+        self.worker.warning.connect(self.on_worker_warning)
+        self.worker.output.connect(self.on_worker_output)
+        self.connect_requested.connect(self.worker.connect_device)
+        self.disconnect_requested.connect(self.worker.disconnect_device)
+        self.send_requested.connect(self.worker.send_text)
+        self.stop_requested.connect(self.worker.stop)
+        self.worker_thread = self.worker.start()
 
     def init_ui(self):
         self.setWindowTitle("PyQt6 Bluetooth SPP Application")
@@ -217,8 +241,7 @@ class SPPBluetoothApp(QMainWindow):
 
         # Received data display
         layout.addWidget(QLabel("Received Data:"))
-        self.received_text = QTextEdit()
-        self.received_text.setReadOnly(True)
+        self.received_text = LogView(max_lines=1000, filters=False)
         self.received_text.setMaximumHeight(200)
         layout.addWidget(self.received_text)
 
@@ -238,8 +261,7 @@ class SPPBluetoothApp(QMainWindow):
 
         # Log display
         layout.addWidget(QLabel("Log:"))
-        self.log_text = QTextEdit()
-        self.log_text.setReadOnly(True)
+        self.log_text = LogView(max_lines=5000)
         layout.addWidget(self.log_text)
 
         # Clear button
@@ -247,15 +269,32 @@ class SPPBluetoothApp(QMainWindow):
         clear_btn.clicked.connect(self.clear_log)
         layout.addWidget(clear_btn)
 
-    def log(self, message):
-        """Add message to log"""
-        self.log_text.append(message)
+    def log(self, message, kind='info'):
+        """Add message to log (kind: info, sent, received or error)"""
+        self.log_text.append(message, kind)
+
+    def add_device(self, name, address):
+        """List a device once per address, True if it is new"""
+        if address in self.devices.values():
+            return False
+        display_text = f"{name} ({address})"
+        self.device_combo.addItem(display_text)
+        self.devices[display_text] = address
+        return True
+
+    def add_known_devices(self):
+        """List devices from the registry, most recently seen first"""
+        for address, fields in self.registry.known():
+            self.add_device(fields.get('name') or "Unknown Device", address)
+        if self.device_combo.count() > 0 and not self.is_connected:
+            self.connect_btn.setEnabled(True)
 
     def scan_devices(self):
         """Start scanning for Bluetooth devices"""
         self.log("Starting device scan...")
         self.device_combo.clear()
         self.devices.clear()
+        self.add_known_devices()
         self.scan_btn.setEnabled(False)
         self.discovery_agent.start()
 
@@ -263,10 +302,9 @@ class SPPBluetoothApp(QMainWindow):
         """Handle discovered device"""
         name = device.name() or "Unknown Device"
         address = device.address().toString()
-        display_text = f"{name} ({address})"
-        self.device_combo.addItem(display_text)
-        self.devices[display_text] = address
-        self.log(f"Found device: {display_text}")
+        self.registry.seen(address, device.name(), class_of_device(device), device.rssi())
+        if self.add_device(name, address):
+            self.log(f"Found device: {name} ({address})")
 
     def on_scan_finished(self):
         """Handle scan completion"""
@@ -277,7 +315,7 @@ class SPPBluetoothApp(QMainWindow):
 
     def on_scan_error(self, error):
         """Handle scan error"""
-        self.log(f"Scan error: {error}")
+        self.log(f"Scan error: {error}", 'error')
         self.scan_btn.setEnabled(True)
 
     def connect_device(self):
@@ -286,83 +324,57 @@ class SPPBluetoothApp(QMainWindow):
             return
 
         address = self.devices[self.device_combo.currentText()]
-        self.log(f"Connecting to {address}...")
-
-        # Create Bluetooth socket
-        self.socket = QBluetoothSocket(QBluetoothServiceInfo.Protocol.RfcommProtocol)
-        self.socket.connected.connect(self.on_connected)
-        self.socket.disconnected.connect(self.on_disconnected)
-        self.socket.readyRead.connect(self.on_data_received)
-        self.socket.errorOccurred.connect(self.on_socket_error)
-
-        # SPP UUID (Serial Port Profile)
-        spp_uuid = QBluetoothUuid(QBluetoothUuid.ServiceClassUuid.SerialPort)
-
-        # Connect to device
-        self.socket.connectToService(QBluetoothAddress(address), spp_uuid)
+        self.connect_requested.emit(address)
 
         self.connect_btn.setEnabled(False)
         self.scan_btn.setEnabled(False)
 
     def on_connected(self):
         """Handle successful connection"""
-        self.log("Connected successfully!")
+        self.is_connected = True
         self.status_label.setText("Status: Connected")
         self.disconnect_btn.setEnabled(True)
         self.send_btn.setEnabled(True)
 
+    def on_interrupted(self, reason):
+        """Link dropped, the worker is reconnecting (Disconnect cancels)"""
+        self.status_label.setText(f"Status: Reconnecting ({reason})...")
+
     def on_disconnected(self):
         """Handle disconnection"""
-        self.log("Disconnected")
+        self.is_connected = False
         self.status_label.setText("Status: Disconnected")
         self.disconnect_btn.setEnabled(False)
         self.send_btn.setEnabled(False)
         self.connect_btn.setEnabled(True)
         self.scan_btn.setEnabled(True)
 
-    def on_socket_error(self, error):
-        """Handle socket errors"""
-        error_msg = self.socket.errorString()
-        self.log(f"Socket error: {error_msg}")
-        QMessageBox.warning(self, "Connection Error", error_msg)
-        self.on_disconnected()
+    def on_worker_warning(self, title, text):
+        """Show a warning reported by the worker"""
+        QMessageBox.warning(self, title, text)
+
+    def on_worker_output(self, lines):
+        """Append a batch of lines from the worker"""
+        for pane, line, kind in lines:
+            if pane == 'received':
+                self.received_text.append(line)
+            else:
+                self.log(line, kind)
 
     def disconnect_device(self):
         """Disconnect from device"""
-        if self.socket and self.socket.state() == QBluetoothSocket.SocketState.ConnectedState:
-            self.log("Disconnecting...")
-            self.socket.disconnectFromService()
-
-    def on_data_received(self):
-        """Handle received data"""
-        if self.socket:
-            data = self.socket.readAll()
-            self.log(f"Raw data received: {len(data)} bytes")
-            try:
-                text = bytes(data).decode('utf-8')
-                self.received_text.append(text)
-                self.log(f"Received: {text}")
-            except UnicodeDecodeError:
-                hex_data = data.toHex().data().decode('ascii')
-                self.received_text.append(f"[Binary: {hex_data}]")
-                self.log(f"Received binary data: {hex_data}")
+        self.disconnect_requested.emit()
 
     def send_data(self):
         """Send data to connected device"""
-        if not self.socket or self.socket.state() != QBluetoothSocket.SocketState.ConnectedState:
+        if not self.is_connected:
             QMessageBox.warning(self, "Not Connected", "Please connect to a device first")
             return
 
         text = self.send_input.text()
         if text:
-            data = text.encode('utf-8')
-            bytes_written = self.socket.write(data)
-            if bytes_written > 0:
-                self.log(f"Sent: {text} ({bytes_written} bytes)")
-                self.send_input.clear()
-            else:
-                self.log("Failed to send data")
-                QMessageBox.warning(self, "Send Error", "Failed to write data to socket")
+            self.send_requested.emit(text)
+            self.send_input.clear()
 
     def clear_log(self):
         """Clear log text"""
@@ -371,8 +383,9 @@ class SPPBluetoothApp(QMainWindow):
 
     def closeEvent(self, event):
         """Handle window close"""
-        if self.socket:
-            self.socket.disconnectFromService()
+        self.stop_requested.emit()
+        self.worker_thread.wait(2000)
+        self.registry.flush()
         event.accept()
 
 
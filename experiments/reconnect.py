@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Reconnect timing shared by slink.py and the SPP GUI tools
+Pure Python, no Qt imports
+"""
+
+import time
+import random
+
+
+class ReconnectBackoff:
+    """Delays between reconnect attempts: exponential, capped and jittered
+
+    Attempt n waits a random time between half and all of
+    min(base * 2**n, cap) seconds, so bricks that dropped together do not
+    retry in lockstep and every wait keeps half its backoff. next()
+    returns None once max_attempts are used up or give_up_after seconds
+    have passed since the first failure; reset() after a good connect.
+    """
+
+    def __init__(self, base=0.25, cap=8.0, max_attempts=None, give_up_after=60.0,
+                 clock=time.monotonic, rand=random.random):
+        self.base = base
+        self.cap = cap
+        self.max_attempts = max_attempts
+        self.give_up_after = give_up_after
+        self.clock = clock
+        self.rand = rand
+        self.attempts = 0
+        self.started = None  # clock() of the first failure
+
+    def next(self):
+        """Seconds to wait before the next attempt, None to give up"""
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        if self.max_attempts is not None and self.attempts >= self.max_attempts:
+            return None
+        if self.give_up_after is not None and now - self.started >= self.give_up_after:
+            return None
+        delay = min(self.base * (1 << min(self.attempts, 30)), self.cap)
+        self.attempts += 1
+        return delay / 2 + self.rand() * delay / 2
+
+    def reset(self):
+        """Connected again, start over at base"""
+        self.attempts = 0
+        self.started = None
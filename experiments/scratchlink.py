@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Scratch Link JSON-RPC helpers shared by slink.py and slink_headless.py
+Pure Python, no Qt imports
+"""
+
+import json
+import struct
+import binascii
+from collections import deque
+
+# Fastest JSON backend available, chosen once at import time
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        """Serialize obj to JSON text"""
+        return orjson.dumps(obj).decode()
+
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        json_loads = ujson.loads
+        json_dumps = ujson.dumps
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        json_loads = json.loads
+        json_dumps = json.dumps
+        JSON_BACKEND = 'json'
+
+
+# didReceiveMessage exactly as json.dumps() renders it, split around the
+# message; base64 needs no JSON escaping, so it is spliced in as is
+_RECEIVE_HEAD, _RECEIVE_TAIL = json.dumps({
+    'jsonrpc': '2.0',
+    'method': 'didReceiveMessage',
+    'params': {
+        'message': '\0',
+        'encoding': 'base64'
+    }
+}).split('\\u0000')
+
+
+def render_received_message(frame):
+    """didReceiveMessage JSON text for one frame (bytes or memoryview)"""
+    encoded = binascii.b2a_base64(frame, newline=False).decode('ascii')
+    return _RECEIVE_HEAD + encoded + _RECEIVE_TAIL
+
+
+# Binary transport, opted into with the setTransport method: each WebSocket
+# binary message is a header (tag, request id) followed by raw EV3 bytes
+BINARY_HEADER = struct.Struct('<BI')
+BINARY_SEND = 0x01  # Client -> server: frames for the device, id 0 = no ack
+BINARY_RECEIVE = 0x02  # Server -> client: one complete frame from the device
+BINARY_SENT = 0x03  # Server -> client: ack, payload is the uint32 bytes written
+_BINARY_SIZE = struct.Struct('<I')
+
+
+def pack_binary(tag, request_id=0, payload=b''):
+    """Binary transport message"""
+    return BINARY_HEADER.pack(tag, request_id) + payload
+
+
+def pack_binary_ack(request_id, size):
+    """Binary transport ack for a BINARY_SEND"""
+    return BINARY_HEADER.pack(BINARY_SENT, request_id) + _BINARY_SIZE.pack(size)
+
+
+def unpack_binary(message):
+    """Split a binary transport message into (tag, request id, payload view)"""
+    if len(message) < BINARY_HEADER.size:
+        raise ValueError("Binary message shorter than its header")
+    tag, request_id = BINARY_HEADER.unpack_from(message)
+    return tag, request_id, memoryview(message)[BINARY_HEADER.size:]
+
+
+def _render_value(value):
+    """JSON text for an id or result, skipping the encoder for common types"""
+    if value is None:
+        return 'null'
+    if type(value) is int:
+        return str(value)
+    return json_dumps(value)
+
+
+def render_result(request_id, result=None):
+    """JSON-RPC result response, e.g. the {"result": null} ack"""
+    return ('{"jsonrpc": "2.0", "id": ' + _render_value(request_id) +
+            ', "result": ' + _render_value(result) + '}')
+
+
+def render_error(message):
+    """JSON-RPC error response"""
+    return '{"jsonrpc": "2.0", "error": {"message": ' + json_dumps(message) + '}}'
+
+
+class MethodTable:
+    """JSON-RPC dispatcher: method name -> handler(request dict)"""
+
+    def __init__(self, methods=None, on_error=None):
+        self.methods = dict(methods or {})
+        self.on_error = on_error  # on_error(message) for bad requests
+
+    def register(self, name, handler):
+        """Add or replace the handler for a method"""
+        self.methods[name] = handler
+
+    def dispatch(self, message):
+        """Parse one message and call its handler, return what it returns"""
+        try:
+            data = json_loads(message)
+        except ValueError:
+            return self.on_error("Invalid JSON")
+        handler = self.methods.get(data.get('method')) if isinstance(data, dict) else None
+        if handler is None:
+            method = data.get('method') if isinstance(data, dict) else None
+            return self.on_error(f"Unknown method: {method}")
+        return handler(data)
+
+
+class SendQueue:
+    """Outgoing Bluetooth frames with coalescing, merging and delayed acks
+
+    push() queues a frame with an ack callback. take() hands out as many
+    queued frames as fit under the socket's high-water mark as one chunk,
+    and confirm() calls the acks once the socket reports their bytes as
+    written. A frame whose merge_key() matches a queued, not yet taken
+    frame replaces it in place (e.g. a newer motor speed for the same
+    port); any frame without a key is a barrier for merging.
+    """
+
+    def __init__(self, high_water=512, merge_key=None):
+        self.high_water = high_water  # Max bytes waiting inside the socket
+        self.merge_key = merge_key
+        self.pending = deque()  # [payload, acks, key] not yet handed to the socket
+        self.mergeable = {}  # merge key -> pending entry
+        self.in_socket = deque()  # (stream end offset, size, acks)
+        self.taken = 0  # Total bytes handed to the socket
+        self.confirmed = 0  # Total bytes the socket reported written
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, payload, ack):
+        """Queue payload; ack(size) once written, ack(None) if dropped"""
+        key = self.merge_key(payload) if self.merge_key else None
+        if key is None:
+            self.mergeable.clear()
+        else:
+            entry = self.mergeable.get(key)
+            if entry is not None:
+                entry[0] = payload
+                entry[1].append(ack)
+                return
+        entry = [payload, [ack], key]
+        self.pending.append(entry)
+        if key is not None:
+            self.mergeable[key] = entry
+
+    def take(self, waiting):
+        """Bytes to write now given waiting bytes already in the socket
+
+        Returns b'' when the socket is above the high-water mark or the
+        queue is empty. A single frame larger than the mark still goes out
+        once the socket is empty.
+        """
+        room = self.high_water - waiting
+        chunk = []
+        size = 0
+        pending = self.pending
+        while pending:
+            payload, acks, key = pending[0]
+            if size + len(payload) > room and (size or waiting):
+                break
+            entry = pending.popleft()
+            if key is not None and self.mergeable.get(key) is entry:
+                del self.mergeable[key]  # Already on its way, too late to merge
+            chunk.append(payload)
+            size += len(payload)
+            self.taken += len(payload)
+            self.in_socket.append((self.taken, len(payload), acks))
+        return b''.join(chunk)
+
+    def confirm(self, written):
+        """Socket wrote written bytes; ack every frame now fully written"""
+        self.confirmed += written
+        in_socket = self.in_socket
+        while in_socket and in_socket[0][0] <= self.confirmed:
+            _, size, acks = in_socket.popleft()
+            for ack in acks:
+                ack(size)
+
+    def clear(self):
+        """Drop everything, acking each frame with None"""
+        dropped = [acks for _, _, acks in self.in_socket]
+        dropped += [acks for _, acks, _ in self.pending]
+        self.pending.clear()
+        self.mergeable.clear()
+        self.in_socket.clear()
+        self.taken = self.confirmed = 0
+        for acks in dropped:
+            for ack in acks:
+                ack(None)
+
+    def interrupt(self):
+        """Link lost: ack frames handed to the socket with None, keep the rest
+
+        Whether the brick got bytes still in the socket's buffer is unknown,
+        so those frames fail; frames never handed out go to the next link.
+        """
+        dropped = [acks for _, _, acks in self.in_socket]
+        self.in_socket.clear()
+        self.taken = self.confirmed = 0
+        for acks in dropped:
+            for ack in acks:
+                ack(None)
@@ -6,136 +6,559 @@ Uses unencrypted WebSocket (WS) instead of WSS
 """
 
 import sys
+import time
 import signal
-import json
-from PyQt6.QtCore import QObject, pyqtSlot, QTimer
-from PyQt6.QtWebSockets import QWebSocketServer, QWebSocket
+import logging
+import argparse
+import binascii
+from functools import partial
+
+# Startup phases for --startup-report (see also: python -X importtime slink.py)
+STARTUP = [('start', time.perf_counter())]
+
+# Only the Qt modules the server needs, no QtWidgets
+from PyQt6.QtCore import QByteArray, QCoreApplication, QObject, pyqtSignal, pyqtSlot, QTimer
+from PyQt6.QtWebSockets import QWebSocketServer
 from PyQt6.QtBluetooth import (
     QBluetoothDeviceDiscoveryAgent,
     QBluetoothDeviceInfo,
     QBluetoothSocket,
     QBluetoothAddress,
-    QBluetoothServiceInfo,
-    QBluetoothServiceDiscoveryAgent,
     QBluetoothUuid,
-    QLowEnergyController
+    QLowEnergyController,
 )
-from PyQt6.QtWidgets import QApplication
 
+STARTUP.append(('qt imports', time.perf_counter()))
 
-class ScratchLinkServer(QObject):
-    """Main server handling WebSocket connections from Scratch"""
+from ev3protocol import EV3FrameReassembler, EV3Protocol, EV3RequestTracker, EV3SensorPoller
+from scratchlink import (BINARY_RECEIVE, BINARY_SEND, MethodTable, SendQueue, json_dumps,
+                         pack_binary, pack_binary_ack, render_error, render_received_message,
+                         render_result, unpack_binary)
 
-    def __init__(self, port, mode='BT'):
-        super().__init__()
-        self.port = port
-        self.mode = mode  # 'BT' for classic, 'BLE' for low energy
-        self.clients = []
+from devicestore import DeviceRegistry, class_of_device, default_registry_path
+from reconnect import ReconnectBackoff
+from logsetup import report_startup, setup_logging
 
-        # Setup WebSocket server (NonSecureMode for WS instead of WSS)
-        self.server = QWebSocketServer(
-            f"Scratch Link {mode}",
-            QWebSocketServer.SslMode.NonSecureMode
-        )
+STARTUP.append(('helper imports', time.perf_counter()))
 
-        # Bluetooth components
-        self.bt_discovery = QBluetoothDeviceDiscoveryAgent()
-        self.bt_discovery.deviceDiscovered.connect(self.on_device_discovered)
-        self.bt_discovery.finished.connect(self.on_discovery_finished)
+log = logging.getLogger('slink')
+discovery_log = logging.getLogger('slink.discovery')
+bt_log = logging.getLogger('slink.bluetooth')
+data_log = logging.getLogger('slink.data')  # Per-message traces, DEBUG only
 
-        self.discovered_devices = {}  # Store discovered devices by address
-        self.bt_socket = None  # For classic Bluetooth
-        self.ble_controller = None  # For BLE
-        self.current_client = None  # Track which client is using BT
-        self.service_discovery = None  # For service discovery
-        self.pending_connect_data = None  # Store connect request data
+# Serial Port Profile UUID, what the EV3 offers (required by BlueZ on Linux)
+SPP_UUID = "00001101-0000-1000-8000-00805F9B34FB"
 
-        # Start server
-        if self.server.listen(port=self.port):
-            print(f"Scratch Link {mode} server listening on WS port {self.port}")
-            self.server.newConnection.connect(self.on_new_connection)
+
+class DeviceCache:
+    """Discovered devices by address with last-seen time and TTL eviction"""
+
+    def __init__(self, ttl=300.0, clock=time.monotonic):
+        self.ttl = ttl  # Seconds a device stays listed without being seen
+        self.clock = clock
+        self.entries = {}  # address -> [QBluetoothDeviceInfo, last seen]
+
+    def __contains__(self, address):
+        return address in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, address, device_info):
+        """Store or refresh a sighting (keeps the newest info and RSSI)"""
+        self.entries[address] = [device_info, self.clock()]
+
+    def get(self, address, default=None):
+        """Device info for address, also for entries past their TTL"""
+        entry = self.entries.get(address)
+        return entry[0] if entry else default
+
+    def evict(self):
+        """Drop devices not seen within the TTL"""
+        deadline = self.clock() - self.ttl
+        for address in [a for a, (_, seen) in self.entries.items() if seen < deadline]:
+            del self.entries[address]
+
+    def devices(self):
+        """Current device infos, evicting stale ones first"""
+        self.evict()
+        return [info for info, _ in self.entries.values()]
+
+
+def registry_device_info(address, fields):
+    """QBluetoothDeviceInfo for a Bluetooth Classic device from the registry"""
+    device = QBluetoothDeviceInfo(QBluetoothAddress(address), fields.get('name') or address,
+                                  fields.get('device_class') or 0)
+    if fields.get('rssi') is not None:
+        device.setRssi(fields['rssi'])
+    return device
+
+
+class DiscoveryFilter:
+    """Matcher compiled from the params of a Scratch Link discover request
+
+    Bluetooth Classic requests carry majorDeviceClass/minorDeviceClass,
+    BLE requests a list of filters with name, namePrefix and services.
+    A device matches when the class fields match and any filter matches.
+    """
+
+    BASE_UUID = '-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, params):
+        params = params or {}
+        self.major = params.get('majorDeviceClass')
+        self.minor = params.get('minorDeviceClass')
+        self.filters = []  # (name, name prefix, frozenset of service uuids)
+        for entry in params.get('filters') or ():
+            services = frozenset(self.normalize_uuid(u) for u in entry.get('services') or ())
+            self.filters.append((entry.get('name'), entry.get('namePrefix'), services))
+        self.needs_services = any(services for _, _, services in self.filters)
+
+    @classmethod
+    def normalize_uuid(cls, uuid):
+        """Lower case UUID string without braces, 16/32-bit numbers expanded"""
+        if isinstance(uuid, int):
+            return f'{uuid:08x}{cls.BASE_UUID}'
+        return str(uuid).strip('{}').lower()
+
+    def match(self, name, major, minor, services=frozenset()):
+        """True if a device with these properties should be reported"""
+        if self.major is not None and major != self.major:
+            return False
+        if self.minor is not None and minor != self.minor:
+            return False
+        if not self.filters:
+            return True
+        for wanted_name, prefix, wanted_services in self.filters:
+            if wanted_name is not None and name != wanted_name:
+                continue
+            if prefix is not None and not name.startswith(prefix):
+                continue
+            if not wanted_services <= services:
+                continue
+            return True
+        return False
+
+    def match_device(self, device):
+        """match() for a QBluetoothDeviceInfo"""
+        services = frozenset()
+        if self.needs_services:
+            services = frozenset(self.normalize_uuid(uuid.toString())
+                                 for uuid in device.serviceUuids())
+        return self.match(device.name(), device.majorDeviceClass().value,
+                          device.minorDeviceClass(), services)
+
+
+class BrickLink(QObject):
+    """One persistent RFCOMM link to a brick, leased to a session at a time
+
+    Between leases the link stays open: it drains and drops whatever the
+    brick still sends, checks the link with an opNOP keepalive and asks
+    the pool to evict it once idle for too long (unless pinned).
+
+    A brick whose RFCOMM channel is cached is connected to that channel
+    directly; SDP (connecting by the SPP UUID) is the fallback, and its
+    result is cached for next time. Leasing sessions listen to connected
+    and failed here rather than to the socket, so a failed direct attempt
+    never reaches them.
+
+    An owned link that drops after being up is reopened with jittered
+    exponential backoff: interrupted is emitted once, connected again when
+    it is back, failed only once the backoff gives up.
+    """
+
+    # Keepalive counters, apart from Scratch's and the session's polling
+    FIRST_COUNTER = 0xE000
+    LAST_COUNTER = 0xEFFF
+
+    connected = pyqtSignal()
+    interrupted = pyqtSignal(str)  # Reason, reconnecting; connected follows on success
+    failed = pyqtSignal(str)  # Error text, the link is unusable
+
+    def __init__(self, pool, address, pinned=False):
+        super().__init__(pool)
+        self.pool = pool
+        self.address = address
+        self.pinned = pinned  # Warm standby link, never evicted for idling
+        self.owner = None  # Leasing session
+
+        self.socket = QBluetoothSocket(self)  # RFCOMM
+        self.socket.connected.connect(self.on_connected)
+        self.socket.readyRead.connect(self.on_ready_read)
+        self.socket.disconnected.connect(self.on_disconnected)
+        self.socket.errorOccurred.connect(self.on_error)
+        self.direct = False  # Connecting to a cached channel, SDP not tried yet
+
+        # Reconnect supervision, for owned links that were up once
+        self.was_connected = False
+        self.reconnecting = False  # Between interrupted and connected/failed
+        self.backoff = ReconnectBackoff(pool.RECONNECT_BASE, pool.RECONNECT_CAP,
+                                        give_up_after=pool.RECONNECT_GIVE_UP)
+        self.reconnect_timer = QTimer(self)
+        self.reconnect_timer.setSingleShot(True)
+        self.reconnect_timer.timeout.connect(self.reconnect)
+
+        # Keepalive replies are matched while idle, and via take_reply() for
+        # a keepalive still in flight when the link was leased
+        self.protocol = EV3Protocol(self.FIRST_COUNTER, self.LAST_COUNTER)
+        self.requests = EV3RequestTracker()
+        self.reassembler = EV3FrameReassembler()
+
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(pool.IDLE_TIMEOUT_MS)
+        self.idle_timer.timeout.connect(lambda: self.pool.evict(self, "idle"))
+        self.keepalive_timer = QTimer(self)
+        self.keepalive_timer.setInterval(pool.KEEPALIVE_MS)
+        self.keepalive_timer.timeout.connect(self.send_keepalive)
+
+    def open(self):
+        """Start connecting, to the cached channel if there is one"""
+        channel = self.pool.registry.channel(self.address)
+        if channel is None:
+            self.open_sdp()
+            return
+        bt_log.info("Opening link to %s on cached RFCOMM channel %d...", self.address, channel)
+        self.direct = True
+        self.socket.connectToService(QBluetoothAddress(self.address), channel)
+
+    def open_sdp(self):
+        """Start connecting by the SPP UUID, Qt looks the channel up with SDP"""
+        bt_log.info("Opening link to %s using SPP UUID...", self.address)
+        self.direct = False
+        self.socket.connectToService(QBluetoothAddress(self.address), QBluetoothUuid(SPP_UUID))
+
+    def retry_sdp(self):
+        """Reset the socket after a failed direct connect and go through SDP"""
+        self.socket.abort()
+        self.open_sdp()
+
+    def on_connected(self):
+        """Remember the channel for direct connects, tell the owner"""
+        bt_log.info("Bluetooth connected to %s", self.address)
+        self.direct = False
+        self.was_connected = True
+        self.reconnecting = False
+        self.backoff.reset()
+        channel = self.socket.peerPort()
+        if channel:
+            self.pool.registry.set_channel(self.address, channel)
+        self.connected.emit()
+
+    def on_error(self, error):
+        """Retry a failed direct connect with SDP, else report the link failed"""
+        if self.direct:
+            bt_log.info("Cached RFCOMM channel of %s failed (%s), trying SDP",
+                        self.address, self.socket.errorString())
+            self.pool.registry.forget_channel(self.address)
+            self.direct = False
+            # Let the socket finish failing before reusing it
+            QTimer.singleShot(0, self.retry_sdp)
+            return
+        error_string = self.socket.errorString()
+        if self.supervise(error_string):
+            return
+        bt_log.error("Bluetooth error on %s: %s - %s", self.address, error, error_string)
+        self.reconnecting = False
+        self.failed.emit(error_string)
+        self.on_lost()
+
+    def on_disconnected(self):
+        """Socket closed without an error: reconnect if owned, else evict"""
+        if self.direct:
+            return  # A failed direct connect, on_error goes on with SDP
+        if self.supervise("disconnected"):
+            return
+        if self.reconnecting:
+            self.reconnecting = False
+            self.failed.emit("disconnected")
+        self.on_lost()
+
+    def supervise(self, reason):
+        """Schedule a reconnect of an owned link, False if it is not ours to retry"""
+        if self.owner is None or not self.was_connected:
+            return False
+        if self.reconnect_timer.isActive():
+            return True  # Error and disconnected for the same drop
+        delay = self.backoff.next()
+        if delay is None:
+            bt_log.error("Giving up on %s after %d reconnect attempts",
+                         self.address, self.backoff.attempts)
+            self.was_connected = False  # Once; later errors for this drop are not retried
+            return False
+        if not self.reconnecting:
+            self.reconnecting = True
+            self.interrupted.emit(reason)
+        bt_log.info("Link to %s lost (%s), reconnect attempt %d in %.2f s",
+                    self.address, reason, self.backoff.attempts, delay)
+        self.reconnect_timer.start(int(delay * 1000))
+        return True
+
+    def reconnect(self):
+        """Reopen the link, cached channel first"""
+        self.socket.blockSignals(True)  # Nothing to report for the dead connection
+        self.socket.abort()
+        self.socket.blockSignals(False)
+        self.open()
+
+    def is_connected(self):
+        """True while the RFCOMM link is up"""
+        return self.socket.state() == QBluetoothSocket.SocketState.ConnectedState
+
+    def is_usable(self):
+        """True while the link is up or still coming up"""
+        return self.socket.state() in (QBluetoothSocket.SocketState.ConnectedState,
+                                       QBluetoothSocket.SocketState.ConnectingState,
+                                       QBluetoothSocket.SocketState.ServiceLookupState)
+
+    def lease(self, owner):
+        """Hand the link to a session"""
+        self.owner = owner
+        self.idle_timer.stop()
+        self.keepalive_timer.stop()
+        if self.socket.bytesAvailable():
+            self.socket.read(self.socket.bytesAvailable())  # Nothing the new owner asked for
+        self.reassembler.reset()
+
+    def release(self):
+        """Take the link back from its session, keep it warm while up"""
+        self.owner = None
+        self.reassembler.reset()
+        if not self.is_usable():
+            self.pool.evict(self, "closed")
+            return
+        if not self.pinned:
+            self.idle_timer.start()
+        self.keepalive_timer.start()
+
+    def on_ready_read(self):
+        """Drain the socket while idle, resolving keepalive replies"""
+        if self.owner is not None:
+            return  # The session reads
+        data = self.socket.read(self.socket.bytesAvailable())
+        for frame in self.reassembler.feed(data):
+            reply = EV3Protocol.parse_reply(frame)
+            if reply:
+                self.requests.resolve(reply)
+
+    def take_reply(self, counter, frame):
+        """True if frame answers the link's own keepalive, resolving it
+
+        A keepalive sent before the lease is answered after it; the
+        session passes frames here so the reply never reaches Scratch.
+        """
+        if counter not in self.requests:
+            return False
+        self.requests.resolve(EV3Protocol.parse_reply(bytes(frame)))
+        return True
+
+    def send_keepalive(self):
+        """Check an idle link with an opNOP, evict it if the brick went away"""
+        self.requests.expire()
+        if len(self.requests) or not self.is_connected():
+            return  # Previous check still out, or still connecting
+        message = self.protocol.nop()
+        self.requests.track(message, self.on_keepalive_reply, self.pool.KEEPALIVE_MS / 2000)
+        self.socket.write(message)
+
+    def on_keepalive_reply(self, reply, error):
+        """Evict an idle link whose keepalive failed"""
+        if error and self.owner is None and error != "Connection closed":
+            self.pool.evict(self, f"keepalive failed: {error}")
+
+    def on_lost(self):
+        """Link went down: evict now if idle, the owner finds out otherwise"""
+        if self.owner is None:
+            self.pool.evict(self, self.socket.errorString() or "disconnected")
+
+    def close(self):
+        """Drop the link for good"""
+        self.idle_timer.stop()
+        self.keepalive_timer.stop()
+        self.reconnect_timer.stop()
+        self.requests.cancel_all()
+        self.socket.blockSignals(True)  # No error reports for a socket we drop
+        self.socket.abort()
+        self.socket.deleteLater()
+        self.deleteLater()
+
+
+class BrickLinkPool(QObject):
+    """Persistent brick links keyed by address, shared across sessions
+
+    Opening an RFCOMM link (SDP lookup and connect) takes seconds, so a
+    session leases the open link instead and gives it back on close; a
+    page reload in Scratch then reconnects at once. Idle links are kept
+    alive and evicted after IDLE_TIMEOUT_MS; warm() opens pinned ones.
+    """
+
+    IDLE_TIMEOUT_MS = 10 * 60 * 1000
+    KEEPALIVE_MS = 15 * 1000
+    RECONNECT_BASE = 0.25  # Seconds before the first reconnect, doubled per attempt
+    RECONNECT_CAP = 8.0
+    RECONNECT_GIVE_UP = 60.0  # Seconds of failed attempts before the session is told
+
+    def __init__(self, registry=None, parent=None):
+        super().__init__(parent)
+        self.links = {}  # address -> BrickLink
+        self.registry = registry if registry is not None else DeviceRegistry()  # Cached RFCOMM channels
+
+    def lease(self, address, owner):
+        """Link to address for owner, opened if there is no usable one"""
+        link = self.links.get(address)
+        if link is not None and not link.is_usable():
+            self.evict(link, "closed")
+            link = None
+        if link is None:
+            link = self.links[address] = BrickLink(self, address)
+            link.open()
         else:
-            print(f"Failed to start server on port {self.port}")
+            bt_log.info("Reusing %s link to %s",
+                        "open" if link.is_connected() else "opening", address)
+        link.lease(owner)
+        return link
 
-    @pyqtSlot()
-    def on_new_connection(self):
-        """Handle new WebSocket connection from Scratch"""
-        client = self.server.nextPendingConnection()
-        if client:
-            print(f"New client connected: {client.peerAddress().toString()}")
-            client.textMessageReceived.connect(self.on_message_received)
-            client.disconnected.connect(lambda: self.on_client_disconnected(client))
-            self.clients.append(client)
+    def release(self, link):
+        """A session is done with link"""
+        link.release()
+
+    def warm(self, address):
+        """Open a pinned link to a known brick ahead of any session"""
+        if address not in self.links:
+            link = self.links[address] = BrickLink(self, address, pinned=True)
+            link.open()
+            link.release()
+
+    def evict(self, link, reason):
+        """Close link and forget it"""
+        if self.links.get(link.address) is link:
+            del self.links[link.address]
+        bt_log.info("Closing link to %s (%s)", link.address, reason)
+        link.close()
+
+    def close_all(self):
+        """Close every link (on shutdown)"""
+        for link in list(self.links.values()):
+            self.evict(link, "shutdown")
+
+
+class ScratchLinkSession(QObject):
+    """One Scratch WebSocket client and the Bluetooth device it owns"""
+
+    SEND_HIGH_WATER = 512  # Bytes allowed in the socket's write buffer
+    SEND_COALESCE_MS = 2  # Window for batching small frames into one write
+    POLL_FIRST_COUNTER = 0xF000  # Message counters 0xF000-0xFFFF are for polling
+    POLL_MIN_INTERVAL_MS = 10
+    DISCOVERY_REPEAT_INTERVAL = 2.0  # Min seconds between reports of a device (RSSI updates)
+
+    def __init__(self, server, client):
+        super().__init__(server)
+        self.server = server
+        self.client = client
+        self.mode = server.mode
+
+        self.bt_link = None  # Leased BrickLink for classic Bluetooth
+        self.bt_socket = None  # Its socket
+        self.bt_connections = []  # Our signal connections to bt_socket
+        self.bt_resuming = False  # Link dropped, sends wait for the reconnect
+        self.bt_reassembler = EV3FrameReassembler()  # One EV3 reply per notification
+        self.ble_controller = None  # For BLE
+        self.peripheral_id = None  # Device owned by this session
+        self.discovery_filter = None  # Matcher of the active discover request, if any
+        self.discovery_sent = {}  # address -> (monotonic time, rssi) last reported
+
+        # Outgoing frames: coalesced for a short window, newer motor speeds
+        # replace queued ones, and at most SEND_HIGH_WATER bytes wait in Qt
+        self.send_queue = SendQueue(self.SEND_HIGH_WATER, EV3Protocol.motor_speed_key)
+        self.send_timer = QTimer(self)
+        self.send_timer.setSingleShot(True)
+        self.send_timer.setInterval(self.SEND_COALESCE_MS)
+        self.send_timer.timeout.connect(self.flush_send_queue)
+
+        # Server-side sensor polling for 'subscribe'; its own counter range
+        # keeps poll replies apart from replies to Scratch's commands
+        self.poll_protocol = EV3Protocol(first_counter=self.POLL_FIRST_COUNTER)
+        self.poll_requests = EV3RequestTracker()
+        self.poller = None
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.poll_sensors)
+
+        # Scratch Link protocol methods
+        self.methods = MethodTable({
+            'discover': partial(self.handle_discover, client),
+            'connect': partial(self.handle_connect, client),
+            'send': partial(self.handle_send, client),
+            'read': partial(self.handle_read, client),
+            'subscribe': partial(self.handle_subscribe, client),
+            'unsubscribe': partial(self.handle_unsubscribe, client),
+            'setTransport': partial(self.handle_set_transport, client),
+        }, on_error=partial(self.send_error, client))
+
+        # Device data as base64 in JSON unless the client opts into binary
+        self.binary = False
+
+        client.textMessageReceived.connect(self.on_message_received)
+        client.binaryMessageReceived.connect(self.on_binary_message_received)
 
     @pyqtSlot(str)
     def on_message_received(self, message):
         """Handle messages from Scratch"""
-        client = self.sender()
-        print(f"Received: {message}")
-
-        try:
-            data = json.loads(message)
-            method = data.get('method')
-
-            # Handle different Scratch Link protocol methods
-            if method == 'discover':
-                self.handle_discover(client, data)
-            elif method == 'connect':
-                self.handle_connect(client, data)
-            elif method == 'send':
-                self.handle_send(client, data)
-            elif method == 'read':
-                self.handle_read(client, data)
-            else:
-                self.send_error(client, f"Unknown method: {method}")
-
-        except json.JSONDecodeError:
-            self.send_error(client, "Invalid JSON")
+        data_log.debug("Received: %s", message)
+        self.methods.dispatch(message)
 
     def handle_discover(self, client, data):
         """Start Bluetooth device discovery"""
-        print(f"Starting {self.mode} discovery...")
-        self.current_client = client
-        self.bt_discovery.start()
+        discovery_log.info("Starting %s discovery...", self.mode)
+        self.discovery_filter = DiscoveryFilter(data.get('params'))
+        self.discovery_sent.clear()
 
         # Send acknowledgment
-        response = {
-            'jsonrpc': '2.0',
-            'id': data.get('id'),
-            'result': None
-        }
-        client.sendTextMessage(json.dumps(response))
+        client.sendTextMessage(render_result(data.get('id')))
+
+        # Known devices show up at once, a scan runs only if the cache is stale
+        for device in self.server.discovered_devices.devices():
+            self.on_device_discovered(device)
+        self.server.start_discovery()
 
     def handle_connect(self, client, data):
         """Connect to a specific Bluetooth device"""
         params = data.get('params', {})
         peripheral_id = params.get('peripheralId')
 
-        print(f"Connecting to device: {peripheral_id}")
-        self.current_client = client
+        bt_log.info("Connecting to device: %s", peripheral_id)
+        if not self.server.claim_device(self, peripheral_id):
+            self.send_error(client, f"Device {peripheral_id} is in use by another client")
+            return
+        self.close_device()
+        self.peripheral_id = peripheral_id
+        self.discovery_filter = None  # Scratch stops discovering once it connects
 
         if self.mode == 'BT':
-            # Classic Bluetooth connection (default is RFCOMM)
-            self.bt_socket = QBluetoothSocket()
-            self.bt_socket.connected.connect(lambda: self.on_bt_connected(client, data))
-            self.bt_socket.errorOccurred.connect(lambda err: self.on_bt_error(client, err))
-            self.bt_socket.readyRead.connect(lambda: self.on_bt_data_ready(client))
-            address = QBluetoothAddress(peripheral_id)
-            # Use Serial Port Profile UUID for EV3 (required by BlueZ on Linux)
-            # SPP UUID: 00001101-0000-1000-8000-00805F9B34FB
-            spp_uuid = QBluetoothUuid("00001101-0000-1000-8000-00805F9B34FB")
-            self.bt_socket.connectToService(address, spp_uuid)
-            print(f"Connecting to {peripheral_id} using SPP UUID...")
+            # Classic Bluetooth: lease the pooled link, open or opened for us
+            self.bt_reassembler.reset()
+            self.bt_link = self.server.links.lease(peripheral_id, self)
+            self.bt_socket = self.bt_link.socket
+            self.bt_connections = [
+                self.bt_link.failed.connect(lambda error: self.on_bt_error(client, error)),
+                self.bt_link.interrupted.connect(self.on_bt_interrupted),
+                self.bt_socket.readyRead.connect(lambda: self.on_bt_data_ready(client)),
+                self.bt_socket.bytesWritten.connect(self.on_bt_bytes_written),
+            ]
+            if self.bt_link.is_connected():
+                self.on_bt_connected(client, data)
+            self.bt_connections.append(
+                self.bt_link.connected.connect(lambda: self.on_bt_connected(client, data)))
         else:
             # BLE connection - need QBluetoothDeviceInfo, not just address
-            if peripheral_id in self.discovered_devices:
-                device_info = self.discovered_devices[peripheral_id]
+            device_info = self.server.discovered_devices.get(peripheral_id)
+            if device_info is not None:
                 # Keep a reference to prevent garbage collection
                 self.ble_controller = QLowEnergyController.createCentral(device_info, self)
                 self.ble_controller.connected.connect(lambda: self.on_ble_connected(client, data))
                 self.ble_controller.errorOccurred.connect(lambda err: self.on_ble_error(client, err))
                 self.ble_controller.connectToDevice()
             else:
+                self.server.release_device(self)
                 self.send_error(client, f"Device {peripheral_id} not found. Please discover devices first.")
 
     def handle_send(self, client, data):
@@ -146,170 +569,440 @@ class ScratchLinkServer(QObject):
 
         # Convert message based on encoding
         if encoding == 'base64':
-            import base64
-            payload = base64.b64decode(message)
+            payload = binascii.a2b_base64(message)
         else:
             payload = message.encode()
 
-        print(f"Payload hex: {payload.hex()}")
+        if data_log.isEnabledFor(logging.DEBUG):
+            data_log.debug("Payload hex: %s", payload.hex())
+        request_id = data.get('id')
+        self.queue_send(client, payload, lambda size: self.on_send_done(client, request_id, size))
 
+    def queue_send(self, client, payload, ack):
+        """Queue payload for the device; ack(size) once written"""
         if self.mode == 'BT' and self.bt_socket:
-            if self.bt_socket.state() == QBluetoothSocket.SocketState.ConnectedState:
-                bytes_written = self.bt_socket.write(payload)
-                self.bt_socket.flush()  # Force send immediately
-                print(f"Sent {bytes_written} bytes to EV3 (state: {self.bt_socket.state()})")
-                response = {
-                    'jsonrpc': '2.0',
-                    'id': data.get('id'),
-                    'result': bytes_written
-                }
-                client.sendTextMessage(json.dumps(response))
+            if self.bt_resuming:
+                self.send_queue.push(payload, ack)  # Written once the link is back
+            elif self.bt_socket.state() == QBluetoothSocket.SocketState.ConnectedState:
+                # Acked once the bytes leave Qt's write buffer, see on_bt_bytes_written
+                self.send_queue.push(payload, ack)
+                if not self.send_timer.isActive():
+                    self.send_timer.start()
             else:
-                print(f"Socket state: {self.bt_socket.state()}")
+                bt_log.warning("Socket state: %s", self.bt_socket.state())
                 self.send_error(client, "Bluetooth socket not connected")
         else:
             self.send_error(client, "No Bluetooth connection available")
 
+    def flush_send_queue(self):
+        """Write queued frames while the socket is below the high-water mark"""
+        if not self.bt_socket or self.bt_resuming:
+            return
+        chunk = self.send_queue.take(self.bt_socket.bytesToWrite())
+        if chunk:
+            self.bt_socket.write(chunk)
+            self.bt_socket.flush()  # Force send immediately
+            data_log.debug("Sent %d bytes to EV3", len(chunk))
+
+    def on_bt_bytes_written(self, written):
+        """Ack frames that reached the socket and keep the queue moving"""
+        self.send_queue.confirm(written)
+        if len(self.send_queue):
+            self.flush_send_queue()
+
+    def on_send_done(self, client, request_id, size):
+        """Answer a send request once its frame was written or dropped"""
+        if size is None:
+            self.send_error(client, "Bluetooth connection closed before sending")
+        else:
+            client.sendTextMessage(render_result(request_id, size))
+
     def handle_read(self, client, data):
         """Read data from connected Bluetooth device"""
         if self.mode == 'BT' and self.bt_socket:
             available = self.bt_socket.bytesAvailable()
             if available > 0:
                 data_bytes = self.bt_socket.read(available)
-                import base64
-                encoded = base64.b64encode(data_bytes).decode()
-
-                response = {
-                    'jsonrpc': '2.0',
-                    'method': 'didReceiveMessage',
-                    'params': {
-                        'message': encoded,
-                        'encoding': 'base64'
-                    }
-                }
-                client.sendTextMessage(json.dumps(response))
+                self.bt_reassembler.feed_views(data_bytes, self.send_received_message)
 
-    @pyqtSlot(QBluetoothDeviceInfo)
     def on_device_discovered(self, device):
-        """Handle discovered Bluetooth device"""
-        device_address = device.address().toString()
-        print(f"Found device: {device.name()} - {device_address}")
-        # Store a copy of the device info for later connection
-        # This prevents garbage collection issues
-        device_copy = QBluetoothDeviceInfo(device)
-        self.discovered_devices[device_address] = device_copy
-        # Send device info to Scratch
-        if hasattr(self, 'current_client'):
-            response = {
-                'jsonrpc': '2.0',
-                'method': 'didDiscoverPeripheral',
-                'params': {
-                    'peripheralId': device_address,
-                    'name': device.name(),
-                    'rssi': device.rssi()
-                }
-            }
-            self.current_client.sendTextMessage(json.dumps(response))
+        """Forward a matching device while this session is discovering"""
+        if self.discovery_filter is None:
+            return
+        address = device.address().toString()
+        rssi = device.rssi()
+        now = time.monotonic()
+        last = self.discovery_sent.get(address)
+        if last is not None:
+            # Repeat sightings only matter for a changed RSSI, and not too often
+            if last[1] == rssi or now - last[0] < self.DISCOVERY_REPEAT_INTERVAL:
+                return
+        elif not self.discovery_filter.match_device(device):
+            return
+        self.discovery_sent[address] = (now, rssi)
 
-    @pyqtSlot()
-    def on_discovery_finished(self):
-        """Discovery scan completed"""
-        print("Discovery finished")
-
-    def on_service_discovered(self, service):
-        """Handle discovered Bluetooth service"""
-        print(f"Found service: {service.serviceName()} - {service.serviceUuid().toString()}")
-        # Connect to the first SPP service found
-        if service.serviceUuid() == QBluetoothUuid("00001101-0000-1000-8000-00805F9B34FB"):
-            print("Found SPP service, connecting...")
-            self.bt_socket.connectToService(service)
-            self.service_discovery.stop()
-
-    def on_service_discovery_finished(self):
-        """Service discovery completed"""
-        print("Service discovery finished")
-        if self.bt_socket and self.bt_socket.state() != QBluetoothSocket.SocketState.ConnectedState:
-            # No SPP service found or connection failed
-            if self.pending_connect_data:
-                client, data = self.pending_connect_data
-                self.send_error(client, "Could not find SPP service on device")
-                self.pending_connect_data = None
-
-    def on_bt_connected(self, client, data):
-        """Classic Bluetooth connection established"""
-        print(f"Bluetooth connected! Socket state: {self.bt_socket.state()}")
-        print(f"Socket is writable: {self.bt_socket.isWritable()}")
-        print(f"Socket is readable: {self.bt_socket.isReadable()}")
         response = {
             'jsonrpc': '2.0',
-            'id': data.get('id'),
-            'result': None
+            'method': 'didDiscoverPeripheral',
+            'params': {
+                'peripheralId': address,
+                'name': device.name(),
+                'rssi': rssi
+            }
         }
-        client.sendTextMessage(json.dumps(response))
+        self.client.sendTextMessage(json_dumps(response))
+
+    def on_bt_connected(self, client, data):
+        """Classic Bluetooth connection established, or back after a drop"""
+        if self.bt_resuming:
+            self.on_bt_resumed()
+            return
+        bt_log.info("Bluetooth connected! Socket state: %s", self.bt_socket.state())
+        bt_log.debug("Socket is writable: %s, readable: %s",
+                     self.bt_socket.isWritable(), self.bt_socket.isReadable())
+        client.sendTextMessage(render_result(data.get('id')))
 
     def on_bt_data_ready(self, client):
         """Handle incoming data from Bluetooth device"""
         if self.bt_socket and self.bt_socket.bytesAvailable() > 0:
-            data_bytes = self.bt_socket.readAll()
-            import base64
-            encoded = base64.b64encode(bytes(data_bytes)).decode()
-            print(f"Received {len(data_bytes)} bytes from EV3")
+            # read() hands back bytes directly, readAll() would add a QByteArray copy
+            data_bytes = self.bt_socket.read(self.bt_socket.bytesAvailable())
+            if data_log.isEnabledFor(logging.DEBUG):
+                data_log.debug("Received %d bytes from EV3: %s", len(data_bytes), data_bytes.hex())
+            # RFCOMM may split or merge replies, forward only complete frames
+            self.bt_reassembler.feed_views(data_bytes, self.send_received_message)
+
+    def send_received_message(self, frame):
+        """Forward one complete EV3 frame to Scratch"""
+        if (len(self.poll_requests) or len(self.bt_link.requests)) and len(frame) >= 5:
+            counter = EV3RequestTracker.COUNTER.unpack_from(frame, 2)[0]
+            if counter in self.poll_requests:
+                self.poll_requests.resolve(EV3Protocol.parse_reply(bytes(frame)))
+                return
+            if self.bt_link.take_reply(counter, frame):
+                return
+        if self.binary:
+            self.client.sendBinaryMessage(pack_binary(BINARY_RECEIVE, 0, frame))
+        else:
+            self.client.sendTextMessage(render_received_message(frame))
+
+    def handle_set_transport(self, client, data):
+        """Switch device data between base64 JSON and binary messages"""
+        self.binary = bool(data.get('params', {}).get('binary', False))
+        client.sendTextMessage(render_result(data.get('id'), self.binary))
+
+    @pyqtSlot(QByteArray)
+    def on_binary_message_received(self, message):
+        """Handle a binary transport message from the client"""
+        client = self.client
+        try:
+            tag, request_id, payload = unpack_binary(bytes(message))
+        except ValueError as error:
+            self.send_error(client, str(error))
+            return
+        if tag != BINARY_SEND:
+            self.send_error(client, f"Unknown binary message tag: {tag}")
+            return
+
+        def ack(size):
+            if size is None:
+                self.send_error(client, "Bluetooth connection closed before sending")
+            elif request_id:
+                client.sendBinaryMessage(pack_binary_ack(request_id, size))
+        self.queue_send(client, bytes(payload), ack)
+
+    def handle_subscribe(self, client, data):
+        """Poll sensors on the server and push changed values
+
+        params: sensors - list of {port, mode}, interval - poll period in
+        ms (default 50), deadband - minimum change to report (default 0)
+        """
+        params = data.get('params', {})
+        if self.mode != 'BT' or not self.bt_connected():
+            self.send_error(client, "No Bluetooth connection available")
+            return
+        try:
+            reads = [(int(sensor['port']), int(sensor.get('mode', 0)))
+                     for sensor in params.get('sensors', [])]
+            interval = max(int(params.get('interval', 50)), self.POLL_MIN_INTERVAL_MS)
+            deadband = float(params.get('deadband', 0.0))
+            if not reads:
+                raise ValueError("no sensors")
+            self.poller = EV3SensorPoller(self.poll_protocol, reads, deadband)
+        except (KeyError, TypeError, ValueError) as error:
+            self.send_error(client, f"Invalid subscribe params: {error}")
+            return
+
+        self.poll_requests.cancel_all()
+        self.poll_timer.start(interval)
+        client.sendTextMessage(render_result(data.get('id')))
+        self.poll_sensors()
+
+    def handle_unsubscribe(self, client, data):
+        """Stop server-side sensor polling"""
+        self.stop_polling()
+        client.sendTextMessage(render_result(data.get('id')))
+
+    def stop_polling(self):
+        """Stop the poll timer and forget the subscription"""
+        self.poll_timer.stop()
+        self.poller = None
+        self.poll_requests.cancel_all()
+
+    def bt_connected(self):
+        """True while the leased link is up and not reconnecting"""
+        return (self.bt_socket is not None and not self.bt_resuming and
+                self.bt_socket.state() == QBluetoothSocket.SocketState.ConnectedState)
+
+    def poll_sensors(self):
+        """Send one batched read unless the previous one is still out"""
+        self.poll_requests.expire()
+        if not self.poller or not self.bt_connected() or len(self.poll_requests):
+            return
+        message = self.poller.build()
+        self.poll_requests.track(message, self.on_poll_reply)
+        self.send_queue.push(message, lambda size: None)
+        if not self.send_timer.isActive():
+            self.send_timer.start()
+
+    def on_poll_reply(self, reply, error):
+        """Push the sensor values that changed since the last report"""
+        poller = self.poller
+        if error or not poller or len(reply['values']) != len(poller.reads):
+            return  # Failed, or the subscription changed while in flight
+        changes = poller.changes(reply['values'])
+        if changes:
             response = {
                 'jsonrpc': '2.0',
                 'method': 'didReceiveMessage',
                 'params': {
-                    'message': encoded,
-                    'encoding': 'base64'
+                    'sensors': [
+                        # NaN (nothing attached) is not valid JSON
+                        {'port': port, 'mode': mode, 'value': value if value == value else None}
+                        for port, mode, value in changes
+                    ]
                 }
             }
-            client.sendTextMessage(json.dumps(response))
+            self.client.sendTextMessage(json_dumps(response))
+
+    def on_bt_interrupted(self, reason):
+        """Link dropped and is reconnecting: hold sends, pause polling
+
+        Frames already in the socket buffer fail, since the brick may or
+        may not have them; queued frames wait and go out on the new link.
+        Scratch sees a stall, not an error, unless the reconnect gives up.
+        """
+        bt_log.warning("Link to %s interrupted (%s), holding %d queued frames",
+                       self.peripheral_id, reason, len(self.send_queue))
+        self.bt_resuming = True
+        self.send_timer.stop()
+        self.send_queue.interrupt()
+        self.bt_reassembler.reset()  # A partial reply from the old link never completes
+        self.poll_timer.stop()
+        self.poll_requests.cancel_all()
 
-    def on_bt_error(self, client, error):
-        """Handle Bluetooth connection error"""
-        error_string = self.bt_socket.errorString() if self.bt_socket else "Unknown error"
-        print(f"Bluetooth error: {error} - {error_string}")
+    def on_bt_resumed(self):
+        """Link is back: replay held frames and re-arm the sensor subscription"""
+        bt_log.info("Link to %s resumed, replaying %d queued frames",
+                    self.peripheral_id, len(self.send_queue))
+        self.bt_resuming = False
+        self.bt_reassembler.reset()
+        if self.poller:
+            self.poll_timer.start()  # Same interval as before
+            self.poll_sensors()
+        self.flush_send_queue()
+
+    def on_bt_error(self, client, error_string):
+        """Handle Bluetooth connection error (logged by the link)
+
+        Also the end of a failed reconnect: held frames fail and polling
+        stops, the client has to connect again.
+        """
+        if self.bt_resuming:
+            self.bt_resuming = False
+            self.stop_polling()
+            self.send_queue.clear()
         self.send_error(client, f"Bluetooth error: {error_string}")
 
     def on_ble_connected(self, client, data):
         """BLE connection established"""
-        print("BLE connected!")
-        response = {
-            'jsonrpc': '2.0',
-            'id': data.get('id'),
-            'result': None
-        }
-        client.sendTextMessage(json.dumps(response))
+        bt_log.info("BLE connected!")
+        client.sendTextMessage(render_result(data.get('id')))
 
     def on_ble_error(self, client, error):
         """Handle BLE connection error"""
-        print(f"BLE error: {error}")
+        bt_log.error("BLE error: %s", error)
         self.send_error(client, f"BLE error: {error}")
 
-    def on_client_disconnected(self, client):
-        """Handle client disconnection"""
-        print("Client disconnected")
-        if client in self.clients:
-            self.clients.remove(client)
+    def close_device(self):
+        """Drop the Bluetooth connection owned by this session"""
+        self.stop_polling()
+        self.send_timer.stop()
+        self.send_queue.clear()
+        self.bt_resuming = False
+        if self.bt_link:
+            # The link stays open in the pool for the next session
+            for connection in self.bt_connections:
+                QObject.disconnect(connection)
+            self.bt_connections = []
+            self.server.links.release(self.bt_link)
+            self.bt_link = None
+            self.bt_socket = None
+        if self.ble_controller:
+            self.ble_controller.blockSignals(True)
+            self.ble_controller.disconnectFromDevice()
+            self.ble_controller.deleteLater()
+            self.ble_controller = None
+        self.peripheral_id = None
+
+    def close(self):
+        """Release everything owned by this session"""
+        self.discovery_filter = None
+        self.close_device()
+        self.server.release_device(self)
 
     def send_error(self, client, message):
         """Send error message to client"""
-        response = {
-            'jsonrpc': '2.0',
-            'error': {
-                'message': message
-            }
-        }
-        client.sendTextMessage(json.dumps(response))
+        client.sendTextMessage(render_error(message))
+
+
+class ScratchLinkServer(QObject):
+    """Main server handling WebSocket connections from Scratch
+
+    Every client gets its own ScratchLinkSession; the discovery agent is
+    shared and a device can be owned by one session at a time.
+    """
+
+    DISCOVERY_REFRESH = 30.0  # Seconds after a finished scan the device cache is fresh
+
+    def __init__(self, port, mode='BT', registry_path=None):
+        super().__init__()
+        self.port = port
+        self.mode = mode  # 'BT' for classic, 'BLE' for low energy
+        self.sessions = {}  # client -> ScratchLinkSession
+        self.device_owners = {}  # peripheral id -> ScratchLinkSession
+        self.registry = DeviceRegistry(registry_path)  # Known devices, kept on disk
+        # Open RFCOMM links, kept across sessions
+        self.links = BrickLinkPool(self.registry, self)
+
+        # Setup WebSocket server (NonSecureMode for WS instead of WSS)
+        self.server = QWebSocketServer(
+            f"Scratch Link {mode}",
+            QWebSocketServer.SslMode.NonSecureMode
+        )
+
+        # Bluetooth components
+        self.bt_discovery = QBluetoothDeviceDiscoveryAgent()
+        self.bt_discovery.deviceDiscovered.connect(self.on_device_discovered)
+        self.bt_discovery.finished.connect(self.on_discovery_finished)
+
+        self.discovered_devices = DeviceCache()  # Store discovered devices by address
+        self.last_scan = None  # Monotonic time the last full scan finished
+        if mode == 'BT':
+            # Known bricks are offered before the first scan finishes
+            for address, fields in self.registry.known():
+                self.discovered_devices.update(address, registry_device_info(address, fields))
+            discovery_log.info("%d devices from the registry", len(self.discovered_devices))
+
+        # Start server
+        if self.server.listen(port=self.port):
+            log.info("Scratch Link %s server listening on WS port %d", mode, self.port)
+            self.server.newConnection.connect(self.on_new_connection)
+        else:
+            log.error("Failed to start server on port %d", self.port)
+
+    @pyqtSlot()
+    def on_new_connection(self):
+        """Handle new WebSocket connection from Scratch"""
+        client = self.server.nextPendingConnection()
+        if client:
+            log.info("New client connected: %s", client.peerAddress().toString())
+            self.sessions[client] = ScratchLinkSession(self, client)
+            client.disconnected.connect(lambda: self.on_client_disconnected(client))
+
+    def start_discovery(self):
+        """Start the shared discovery agent if the cache is stale and no scan runs"""
+        if self.bt_discovery.isActive():
+            return
+        if self.last_scan is not None and time.monotonic() - self.last_scan < self.DISCOVERY_REFRESH:
+            discovery_log.info("Using %d cached devices", len(self.discovered_devices))
+            return
+        self.bt_discovery.start()
+
+    def claim_device(self, session, peripheral_id):
+        """Make session the owner of a device, False if another session has it"""
+        owner = self.device_owners.get(peripheral_id)
+        if owner is not None and owner is not session:
+            return False
+        self.release_device(session)
+        self.device_owners[peripheral_id] = session
+        return True
+
+    def release_device(self, session):
+        """Forget any device owned by session"""
+        for peripheral_id, owner in list(self.device_owners.items()):
+            if owner is session:
+                del self.device_owners[peripheral_id]
+
+    @pyqtSlot(QBluetoothDeviceInfo)
+    def on_device_discovered(self, device):
+        """Handle discovered Bluetooth device"""
+        device_address = device.address().toString()
+        discovery_log.debug("Found device: %s - %s", device.name(), device_address)
+        # Store a copy of the device info for later connection
+        # This prevents garbage collection issues
+        device_copy = QBluetoothDeviceInfo(device)
+        self.discovered_devices.update(device_address, device_copy)
+        if self.mode == 'BT':
+            self.registry.seen(device_address, device.name(), class_of_device(device),
+                               device.rssi())
+        # Send device info to every client that is discovering
+        for session in self.sessions.values():
+            session.on_device_discovered(device_copy)
+
+    @pyqtSlot()
+    def on_discovery_finished(self):
+        """Discovery scan completed"""
+        discovery_log.info("Discovery finished")
+        self.last_scan = time.monotonic()
+
+    def on_client_disconnected(self, client):
+        """Handle client disconnection"""
+        log.info("Client disconnected")
+        session = self.sessions.pop(client, None)
+        if session:
+            session.close()
+            session.deleteLater()
+        client.deleteLater()
 
 
 def signal_handler(sig, frame):
     """Handle Ctrl+C gracefully"""
-    print("\nCtrl+C detected, shutting down...")
-    QApplication.quit()
+    log.info("Ctrl+C detected, shutting down...")
+    QCoreApplication.quit()
 
 
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Scratch Link server (Qt)")
+    parser.add_argument('--port', type=int, default=20111, help="WebSocket port (default 20111)")
+    parser.add_argument('--mode', choices=('BT', 'BLE'), default='BT',
+                        help="BT for Bluetooth Classic (EV3), BLE for Low Energy")
+    parser.add_argument('--warm', action='append', default=[], metavar='ADDRESS',
+                        help="keep a link to this brick open from startup (repeatable)")
+    parser.add_argument('--registry', default=default_registry_path(), metavar='PATH',
+                        help="known device registry file ('' keeps it in memory)")
+    parser.add_argument('--debug', action='store_true',
+                        help="log everything incl. message and hex traces, no rate limit")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="print startup phase timings and peak RSS")
+    parser.add_argument('--exit-after-start', action='store_true',
+                        help="quit once the server listens (for startup benchmarks)")
+    args = parser.parse_args()
+    setup_logging(debug=args.debug)
+
+    # No window is ever shown, so a core application is enough
+    app = QCoreApplication(sys.argv)
+    STARTUP.append(('application', time.perf_counter()))
 
     # Set up signal handler
     signal.signal(signal.SIGINT, signal_handler)
@@ -321,14 +1014,21 @@ def main():
     timer.timeout.connect(lambda: None)
     timer.start(500)
 
-    # Start both BT and BLE servers on WS (unencrypted)
-    bt_server = ScratchLinkServer(20111, 'BT')   # Classic Bluetooth
-    #bt_server = ScratchLinkServer(20110, 'BT')   # Classic Bluetooth
-    #ble_server = ScratchLinkServer(20111, 'BLE')  # Bluetooth Low Energy
+    # Scratch Link exposes one port, BT Classic and BLE are told apart internally
+    server = ScratchLinkServer(args.port, args.mode, args.registry or None)
+    STARTUP.append(('server listen', time.perf_counter()))
+    app.aboutToQuit.connect(server.links.close_all)
+    app.aboutToQuit.connect(server.registry.flush)
+    if args.mode == 'BT':
+        for address in args.warm:
+            server.links.warm(address)
 
+    log.info("Connect from Scratch using ws://localhost:%d (WS mode - unencrypted)", args.port)
 
-    print("\nScratch Link servers started (WS mode - unencrypted)!")
-    print("Connect from Scratch using ws://localhost:20110 and ws://localhost:20111")
+    if args.startup_report:
+        report_startup(STARTUP)
+    if args.exit_after_start:
+        return
 
     sys.exit(app.exec())
 
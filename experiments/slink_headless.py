@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Headless Scratch Link server using asyncio
+Speaks the same JSON-RPC methods as slink.py (discover, connect, send, read)
+without Qt: WebSocket via the websockets package, Bluetooth Classic via a
+raw AF_BLUETOOTH RFCOMM socket (Linux only)
+"""
+
+import time
+import base64
+import socket
+import asyncio
+import logging
+import argparse
+
+STARTUP = [('start', time.perf_counter())]
+
+import websockets
+
+from ev3protocol import EV3FrameReassembler
+from scratchlink import (BINARY_RECEIVE, BINARY_SEND, MethodTable, json_dumps, pack_binary,
+                         pack_binary_ack, render_error, render_received_message, render_result,
+                         unpack_binary)
+
+from devicestore import DeviceRegistry, default_registry_path
+from logsetup import report_startup, setup_logging
+
+STARTUP.append(('imports', time.perf_counter()))
+
+log = logging.getLogger('slink')
+data_log = logging.getLogger('slink.data')  # Per-message traces, DEBUG only
+
+
+# The EV3 exposes its Serial Port Profile on RFCOMM channel 1; without
+# Qt there is no SDP lookup, so clients may override it in connect params,
+# else the channel slink.py found through SDP is used if cached
+DEFAULT_RFCOMM_CHANNEL = 1
+
+
+async def list_known_devices():
+    """Return (address, name) pairs of devices known to BlueZ
+
+    A raw socket cannot run an inquiry scan, so discovery reports the
+    devices bluetoothctl already knows (paired or seen before).
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'bluetoothctl', 'devices',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+    except FileNotFoundError:
+        log.warning("bluetoothctl not found, discovery returns no devices")
+        return []
+    output, _ = await process.communicate()
+
+    devices = []
+    for line in output.decode(errors='replace').splitlines():
+        # Device 00:16:53:AA:BB:CC EV3
+        parts = line.split(' ', 2)
+        if len(parts) >= 2 and parts[0] == 'Device':
+            devices.append((parts[1], parts[2] if len(parts) > 2 else parts[1]))
+    return devices
+
+
+class HeadlessSession:
+    """One Scratch WebSocket client and the EV3 it is connected to"""
+
+    def __init__(self, websocket, registry):
+        self.websocket = websocket
+        self.registry = registry  # DeviceRegistry
+        self.bt_socket = None
+        self.reader_task = None
+        self.reassembler = EV3FrameReassembler()
+        self.methods = MethodTable({
+            'discover': self.handle_discover,
+            'connect': self.handle_connect,
+            'send': self.handle_send,
+            'read': self.handle_read,
+            'setTransport': self.handle_set_transport,
+        }, on_error=self.send_error)
+        self.binary = False  # Device data as base64 in JSON unless opted in
+
+    async def run(self):
+        """Serve JSON-RPC requests until the client disconnects"""
+        try:
+            async for message in self.websocket:
+                if isinstance(message, bytes):
+                    await self.on_binary_message_received(message)
+                else:
+                    await self.on_message_received(message)
+        finally:
+            self.close()
+
+    async def on_message_received(self, message):
+        """Handle messages from Scratch (handlers are coroutines)"""
+        data_log.debug("Received: %s", message)
+        await self.methods.dispatch(message)
+
+    async def handle_discover(self, data):
+        """Report devices from the registry, then those known to BlueZ"""
+        await self.send_result(data, None)
+        reported = set()
+        for address, fields in self.registry.known():
+            reported.add(address)
+            await self.send_peripheral(address, fields.get('name') or address,
+                                       fields.get('rssi') or 0)
+        for address, name in await list_known_devices():
+            if address.upper() not in reported:
+                await self.send_peripheral(address, name, 0)
+
+    async def send_peripheral(self, address, name, rssi):
+        """Send one didDiscoverPeripheral notification"""
+        await self.send_json({
+            'jsonrpc': '2.0',
+            'method': 'didDiscoverPeripheral',
+            'params': {
+                'peripheralId': address,
+                'name': name,
+                'rssi': rssi
+            }
+        })
+
+    async def handle_connect(self, data):
+        """Open an RFCOMM link to the device
+
+        A channel from the registry that fails is forgotten and the
+        default channel tried instead, like SDP is in slink.py.
+        """
+        params = data.get('params', {})
+        peripheral_id = params.get('peripheralId')
+        if not isinstance(peripheral_id, str):
+            await self.send_error("connect needs a peripheralId")
+            return
+        cached = None if params.get('channel') else self.registry.channel(peripheral_id)
+        channel = params.get('channel') or cached or DEFAULT_RFCOMM_CHANNEL
+
+        self.close()
+        self.reassembler.reset()
+        try:
+            bt_socket = await self.open_rfcomm(peripheral_id, channel)
+        except OSError as error:
+            if cached is None or cached == DEFAULT_RFCOMM_CHANNEL:
+                await self.send_error(f"Bluetooth error: {error}")
+                return
+            log.info("Cached RFCOMM channel %d of %s failed (%s), trying channel %d",
+                     cached, peripheral_id, error, DEFAULT_RFCOMM_CHANNEL)
+            self.registry.forget_channel(peripheral_id)
+            channel = DEFAULT_RFCOMM_CHANNEL
+            try:
+                bt_socket = await self.open_rfcomm(peripheral_id, channel)
+            except OSError as error:
+                await self.send_error(f"Bluetooth error: {error}")
+                return
+
+        log.info("Bluetooth connected to %s", peripheral_id)
+        self.registry.set_channel(peripheral_id, channel)
+        self.bt_socket = bt_socket
+        self.reader_task = asyncio.create_task(self.read_loop(bt_socket))
+        await self.send_result(data, None)
+
+    @staticmethod
+    async def open_rfcomm(address, channel):
+        """Connected non-blocking RFCOMM socket, raises OSError"""
+        log.info("Connecting to %s on RFCOMM channel %s...", address, channel)
+        bt_socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
+                                  socket.BTPROTO_RFCOMM)
+        bt_socket.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(bt_socket, (address, channel))
+        except OSError:
+            bt_socket.close()
+            raise
+        return bt_socket
+
+    async def handle_send(self, data):
+        """Send data to connected Bluetooth device"""
+        params = data.get('params', {})
+        message = params.get('message')
+        if params.get('encoding', 'base64') == 'base64':
+            payload = base64.b64decode(message)
+        else:
+            payload = message.encode()
+
+        if await self.write_device(payload):
+            await self.send_result(data, len(payload))
+
+    async def write_device(self, payload):
+        """Write payload to the device, True once the kernel has it"""
+        if data_log.isEnabledFor(logging.DEBUG):
+            data_log.debug("Payload hex: %s", bytes(payload).hex())
+        if not self.bt_socket:
+            await self.send_error("No Bluetooth connection available")
+            return False
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.sock_sendall(self.bt_socket, payload)
+        except OSError as error:
+            await self.send_error(f"Bluetooth error: {error}")
+            return False
+        return True
+
+    async def handle_set_transport(self, data):
+        """Switch device data between base64 JSON and binary messages"""
+        self.binary = bool(data.get('params', {}).get('binary', False))
+        await self.send_result(data, self.binary)
+
+    async def on_binary_message_received(self, message):
+        """Handle a binary transport message from the client"""
+        try:
+            tag, request_id, payload = unpack_binary(message)
+        except ValueError as error:
+            await self.send_error(str(error))
+            return
+        if tag != BINARY_SEND:
+            await self.send_error(f"Unknown binary message tag: {tag}")
+            return
+        if await self.write_device(payload) and request_id:
+            await self.send_text(pack_binary_ack(request_id, len(payload)))
+
+    async def handle_read(self, data):
+        """Received frames are pushed by read_loop, nothing to poll"""
+
+    async def read_loop(self, bt_socket):
+        """Forward complete EV3 frames to Scratch as they arrive"""
+        loop = asyncio.get_running_loop()
+        buffer = bytearray(1024)  # Reused for every read
+        view = memoryview(buffer)
+        messages = []
+        while True:
+            try:
+                size = await loop.sock_recv_into(bt_socket, buffer)
+            except OSError as error:
+                await self.send_error(f"Bluetooth error: {error}")
+                return
+            if not size:
+                log.info("Bluetooth disconnected")
+                return
+            if data_log.isEnabledFor(logging.DEBUG):
+                data_log.debug("Received %d bytes from EV3: %s", size, buffer[:size].hex())
+            render = self.render_binary if self.binary else render_received_message
+            self.reassembler.feed_views(view[:size], lambda frame: messages.append(render(frame)))
+            for message in messages:
+                await self.send_text(message)
+            messages.clear()
+
+    @staticmethod
+    def render_binary(frame):
+        """Binary transport message for one received frame"""
+        return pack_binary(BINARY_RECEIVE, 0, frame)
+
+    def close(self):
+        """Drop the Bluetooth link, if any"""
+        if self.reader_task:
+            self.reader_task.cancel()
+            self.reader_task = None
+        if self.bt_socket:
+            self.bt_socket.close()
+            self.bt_socket = None
+
+    async def send_json(self, response):
+        """Send one JSON-RPC message"""
+        await self.send_text(json_dumps(response))
+
+    async def send_text(self, text):
+        """Send a rendered message (str as text, bytes as binary), ignoring a closed client"""
+        try:
+            await self.websocket.send(text)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_result(self, data, result):
+        """Send a JSON-RPC result for request data"""
+        await self.send_text(render_result(data.get('id'), result))
+
+    async def send_error(self, message):
+        """Send error message to client"""
+        await self.send_text(render_error(message))
+
+
+async def handle_client(websocket, registry):
+    """Serve one Scratch WebSocket connection"""
+    log.info("New client connected: %s", websocket.remote_address)
+    await HeadlessSession(websocket, registry).run()
+    log.info("Client disconnected")
+
+
+async def serve(port, startup_report=False, exit_after_start=False, registry_path=None):
+    """Run the Scratch Link server until cancelled"""
+    registry = DeviceRegistry(registry_path)
+    STARTUP.append(('device registry', time.perf_counter()))
+    try:
+        async with websockets.serve(lambda websocket, *args: handle_client(websocket, registry),
+                                    'localhost', port):
+            STARTUP.append(('server listen', time.perf_counter()))
+            log.info("Scratch Link BT server listening on WS port %d (headless), %d known devices",
+                     port, len(registry))
+            if startup_report:
+                report_startup(STARTUP)
+            if exit_after_start:
+                return
+            await asyncio.get_running_loop().create_future()
+    finally:
+        registry.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scratch Link server (headless, asyncio)")
+    parser.add_argument('--port', type=int, default=20111, help="WebSocket port (default 20111)")
+    parser.add_argument('--registry', default=default_registry_path(), metavar='PATH',
+                        help="known device registry file ('' keeps it in memory)")
+    parser.add_argument('--debug', action='store_true',
+                        help="log everything incl. message and hex traces, no rate limit")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="print startup phase timings and peak RSS")
+    parser.add_argument('--exit-after-start', action='store_true',
+                        help="quit once the server listens (for startup benchmarks)")
+    args = parser.parse_args()
+    setup_logging(debug=args.debug)
+    try:
+        asyncio.run(serve(args.port, args.startup_report, args.exit_after_start,
+                          args.registry or None))
+    except KeyboardInterrupt:
+        log.info("Ctrl+C detected, shutting down...")
+
+
+if __name__ == '__main__':
+    main()
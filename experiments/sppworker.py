@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Bluetooth SPP socket worker for the GUI tools
+The QBluetoothSocket, reply parsing and hex formatting run in their own
+QThread; the window talks to the worker through queued signals only, and
+gets log lines back in batches at a fixed refresh rate. A link that drops
+is reconnected with jittered exponential backoff
+"""
+
+from PyQt6.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+from PyQt6.QtBluetooth import (QBluetoothSocket, QBluetoothAddress, QBluetoothUuid,
+                               QBluetoothServiceInfo)
+
+from reconnect import ReconnectBackoff
+
+
+class SPPWorker(QObject):
+    """Owns the SPP socket; subclasses override handle_data() for protocols
+
+    Create it on the GUI thread, then start() moves it to a new thread.
+    Slots must only be reached through signals from then on.
+    """
+
+    OUTPUT_MS = 50  # Log lines reach the window at most 20 times a second
+
+    connected = pyqtSignal()  # Also when back after interrupted
+    interrupted = pyqtSignal(str)  # Link dropped, reconnecting
+    disconnected = pyqtSignal()
+    warning = pyqtSignal(str, str)  # Title, text for a message box
+    output = pyqtSignal(list)  # Batched (pane, line, kind), pane 'log' or 'received'
+
+    def __init__(self):
+        super().__init__()
+        self.socket = None
+        self.lines = []  # Output not yet handed to the window
+        self.output_timer = None
+
+        # Reconnect supervision: address is None after a requested disconnect
+        self.address = None
+        self.was_connected = False
+        self.reconnecting = False
+        self.down = True  # Disconnection reported, later signals are stale
+        self.backoff = ReconnectBackoff()
+        self.reconnect_timer = None
+
+    def start(self):
+        """Move the worker to a new thread and start it, return the thread"""
+        thread = QThread()
+        self.moveToThread(thread)
+        thread.started.connect(self.setup)
+        thread.start()
+        return thread
+
+    @pyqtSlot()
+    def setup(self):
+        """Create timers in the worker thread (runs once it starts)"""
+        self.output_timer = QTimer(self)
+        self.output_timer.timeout.connect(self.flush_output)
+        self.output_timer.start(self.OUTPUT_MS)
+
+        self.reconnect_timer = QTimer(self)
+        self.reconnect_timer.setSingleShot(True)
+        self.reconnect_timer.timeout.connect(self.reconnect)
+
+    def log(self, line, kind='info'):
+        """Queue a log line (kind: info, sent, received or error)"""
+        self.lines.append(('log', line, kind))
+
+    def show(self, line):
+        """Queue a line for the received data pane"""
+        self.lines.append(('received', line, 'received'))
+
+    @pyqtSlot()
+    def flush_output(self):
+        """Hand queued lines to the window in one signal"""
+        if self.lines:
+            self.output.emit(self.lines)
+            self.lines = []
+
+    def is_connected(self):
+        """True while the socket is connected"""
+        return (self.socket is not None and
+                self.socket.state() == QBluetoothSocket.SocketState.ConnectedState)
+
+    @pyqtSlot(str)
+    def connect_device(self, address):
+        """Connect to address via SPP"""
+        self.log(f"Connecting to {address}...")
+        self.reset()
+        self.address = address
+        self.was_connected = False
+        self.reconnecting = False
+        self.down = False
+        self.backoff.reset()
+        self.reconnect_timer.stop()
+        self.open_socket()
+
+    def open_socket(self):
+        """Replace the socket with a new one connecting to self.address"""
+        if self.socket:
+            self.socket.blockSignals(True)  # No stale disconnected() from the old link
+            self.socket.abort()
+            self.socket.deleteLater()
+
+        self.socket = QBluetoothSocket(QBluetoothServiceInfo.Protocol.RfcommProtocol, self)
+        self.socket.connected.connect(self.on_connected)
+        self.socket.disconnected.connect(self.on_disconnected)
+        self.socket.readyRead.connect(self.on_data_received)
+        self.socket.errorOccurred.connect(self.on_socket_error)
+
+        # SPP UUID (Serial Port Profile)
+        spp_uuid = QBluetoothUuid(QBluetoothUuid.ServiceClassUuid.SerialPort)
+        self.socket.connectToService(QBluetoothAddress(self.address), spp_uuid)
+
+    @pyqtSlot()
+    def disconnect_device(self):
+        """Disconnect from the device, or stop reconnecting to it"""
+        self.address = None  # Requested, so no reconnect
+        if self.is_connected():
+            self.log("Disconnecting...")
+            self.socket.disconnectFromService()
+        elif self.reconnecting:
+            self.log("Reconnect cancelled")
+            self.reconnect_timer.stop()
+            self.reconnecting = False
+            self.socket.blockSignals(True)
+            self.socket.abort()
+            self.on_disconnected()
+
+    def on_connected(self):
+        """Handle successful connection"""
+        self.log("Reconnected" if self.reconnecting else "Connected successfully!")
+        self.was_connected = True
+        self.reconnecting = False
+        self.backoff.reset()
+        self.flush_output()  # Lines first, so the window sees them in order
+        self.connected.emit()
+
+    def on_disconnected(self):
+        """Handle disconnection, reconnecting if the link dropped"""
+        if self.down or self.supervise("disconnected"):
+            return
+        self.log("Disconnected")
+        self.down = True
+        self.reconnecting = False
+        self.reset()
+        self.flush_output()
+        self.disconnected.emit()
+
+    def on_socket_error(self, error):
+        """Handle socket errors, only reported once reconnecting gives up"""
+        error_msg = self.socket.errorString()
+        self.log(f"Socket error: {error_msg}", 'error')
+        if self.down or self.supervise(error_msg):
+            return
+        self.flush_output()
+        self.warning.emit("Connection Error", error_msg)
+        self.on_disconnected()
+
+    def supervise(self, reason):
+        """Schedule a reconnect after a drop, False if there is none to make"""
+        if self.address is None or not self.was_connected:
+            return False
+        if self.reconnect_timer.isActive():
+            return True  # Error and disconnected for the same drop
+        delay = self.backoff.next()
+        if delay is None:
+            self.log(f"Giving up after {self.backoff.attempts} reconnect attempts", 'error')
+            self.address = None  # Once; the error and disconnected that follow just report
+            return False
+        if not self.reconnecting:
+            self.reconnecting = True
+            self.interrupt()
+            self.flush_output()
+            self.interrupted.emit(reason)
+        self.log(f"Link lost ({reason}), reconnect attempt {self.backoff.attempts} "
+                 f"in {delay:.1f} s", 'error')
+        self.reconnect_timer.start(int(delay * 1000))
+        return True
+
+    @pyqtSlot()
+    def reconnect(self):
+        """Reopen the link to the same device"""
+        self.log(f"Reconnecting to {self.address}...")
+        self.open_socket()
+
+    def reset(self):
+        """Forget per-connection state (subclasses drop pending requests)"""
+
+    def interrupt(self):
+        """Link dropped, reconnecting: fail what was in flight (subclasses)"""
+        self.reset()
+
+    def on_data_received(self):
+        """Read everything the socket has and pass it on"""
+        if self.socket:
+            self.handle_data(bytes(self.socket.readAll()))
+
+    def handle_data(self, data):
+        """Show received bytes as text, or hex if they are not UTF-8"""
+        self.log(f"Raw data received: {len(data)} bytes", 'received')
+        try:
+            text = data.decode('utf-8')
+            self.show(text)
+            self.log(f"Received: {text}", 'received')
+        except UnicodeDecodeError:
+            hex_data = data.hex()
+            self.show(f"[Binary: {hex_data}]")
+            self.log(f"Received binary data: {hex_data}", 'received')
+
+    @pyqtSlot(str)
+    def send_text(self, text):
+        """Send text as UTF-8"""
+        if not self.is_connected():
+            return
+        bytes_written = self.socket.write(text.encode('utf-8'))
+        if bytes_written > 0:
+            self.log(f"Sent: {text} ({bytes_written} bytes)", 'sent')
+        else:
+            self.log("Failed to send data", 'error')
+            self.flush_output()
+            self.warning.emit("Send Error", "Failed to write data to socket")
+
+    @pyqtSlot()
+    def stop(self):
+        """Close the socket and end the worker thread"""
+        self.address = None
+        self.reconnect_timer.stop()
+        if self.socket:
+            self.socket.disconnectFromService()
+        self.flush_output()
+        self.thread().quit()
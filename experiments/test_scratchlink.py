@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Tests for SendQueue merging of motor speed frames (run: python -m pytest)
+"""
+
+from ev3protocol import EV3Protocol
+from scratchlink import SendQueue
+
+
+def speed_only(ev3, motor_bits, speed):
+    """start_motor() frame without its trailing opOUTPUT_START"""
+    message = bytearray(ev3.start_motor(motor_bits, speed)[:-3])
+    message[0:2] = (len(message) - 2).to_bytes(2, 'little')
+    return bytes(message)
+
+
+def test_speed_only_key_differs_from_start():
+    ev3 = EV3Protocol()
+    start = EV3Protocol.motor_speed_key(ev3.start_motor(1, 50))
+    speed = EV3Protocol.motor_speed_key(speed_only(ev3, 1, 30))
+    assert start is not None and speed is not None
+    assert start != speed
+
+
+def test_speed_only_does_not_replace_queued_start():
+    ev3 = EV3Protocol()
+    queue = SendQueue(merge_key=EV3Protocol.motor_speed_key)
+    start = ev3.start_motor(1, 50)
+    speed = speed_only(ev3, 1, 30)
+    queue.push(start, lambda size: None)
+    queue.push(speed, lambda size: None)
+    assert queue.take(0) == start + speed
+
+
+def test_same_shape_merges():
+    ev3 = EV3Protocol()
+    queue = SendQueue(merge_key=EV3Protocol.motor_speed_key)
+    acks = []
+    queue.push(ev3.start_motor(1, 50), acks.append)
+    newer = ev3.start_motor(1, 30)
+    queue.push(newer, acks.append)
+    chunk = queue.take(0)
+    assert chunk == newer
+    queue.confirm(len(chunk))
+    assert acks == [len(newer), len(newer)]